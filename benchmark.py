@@ -0,0 +1,229 @@
+"""
+Codec and dispatch micro-benchmarks
+
+Runs entirely in-process (no network) and prints the results as JSON:
+
+    python benchmark.py [--quick] [--output FILE] [--compare BASELINE]
+
+Each result records the benchmark `name`, `ops_per_sec` (messages, or
+publishes, per second; best of several repeats).  The benchmarks that
+keep the result of each operation (loads and str) also record
+`retained_objects_per_op`: the number of objects tracked by the garbage
+collector that the result holds, counted with the collector's
+generation-0 counter while collection is disabled.  The counter is net
+of objects freed, so it says nothing about temporary allocations, and
+benchmarks that discard their results (handle_wamp_message and publish)
+do not report it.
+
+Publish benchmarks also report `deliveries_per_sec`.
+
+With --compare, results are checked against a previous --output file and
+the script exits with status 1 if any benchmark's ops_per_sec dropped by
+more than --tolerance (a fraction; default 0.2).
+"""
+import argparse
+import gc
+import json
+import sys
+from timeit import default_timer
+
+from wampmessage import WAMPMessage, WAMPMessageType
+from wampsession import WAMPSession
+from pubsub import PubSub
+
+
+SAMPLES = {
+    WAMPMessageType.WELCOME: '[0, "session1", 1, "server/1.0"]',
+    WAMPMessageType.PREFIX: '[1, "calc", "http://example.com/calc#"]',
+    WAMPMessageType.CALL: '[2, "call1", "calc:add", 23, 99]',
+    WAMPMessageType.CALLRESULT: '[3, "call1", {"value": 122}]',
+    WAMPMessageType.CALLERROR: ('[4, "call1", "http://example.com/error", '
+                                '"description", {"code": 500}]'),
+    WAMPMessageType.SUBSCRIBE: '[5, "http://example.com/topic"]',
+    WAMPMessageType.UNSUBSCRIBE: '[6, "http://example.com/topic"]',
+    WAMPMessageType.PUBLISH: ('[7, "http://example.com/topic", '
+                              '{"symbol": "ABC", "price": 12.5, '
+                              '"volume": [100, 200, 300]}]'),
+    WAMPMessageType.EVENT: ('[8, "http://example.com/topic", '
+                            '{"symbol": "ABC", "price": 12.5, '
+                            '"volume": [100, 200, 300]}]'),
+}
+
+
+def measure(name, op, count, repeat=3, retain=True):
+    """
+    times `count` calls of op(i), returning the best of `repeat` runs
+
+    If `retain` is True, the results of op are kept until the run ends,
+    and retained_objects_per_op reports the objects they hold
+    """
+    results = [None] * count if retain else None
+    best = None
+    retained = None
+    gc.collect()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for run in range(repeat):
+            gc.collect()
+            before = gc.get_count()[0]
+            start = default_timer()
+            if retain:
+                for i in xrange(count):
+                    results[i] = op(i)
+            else:
+                for i in xrange(count):
+                    op(i)
+            elapsed = default_timer() - start
+            objects = gc.get_count()[0] - before
+            if best is None or elapsed < best:
+                best = elapsed
+                retained = objects
+            if retain:
+                results = [None] * count
+    finally:
+        if gc_enabled:
+            gc.enable()
+    result = {'name': name,
+              'ops': count,
+              'ops_per_sec': count / best if best > 0 else float('inf')}
+    if retain:
+        result['retained_objects_per_op'] = float(retained) / count
+    return result
+
+
+def bench_loads(count):
+    results = []
+    for message_type, raw in sorted(SAMPLES.items()):
+        results.append(measure('loads.%s' % message_type.str,
+                               lambda i, raw=raw: WAMPMessage.loads(raw),
+                               count))
+        results.append(measure('loads_lazy.%s' % message_type.str,
+                               lambda i, raw=raw: WAMPMessage.loads(
+                                   raw, lazy=True),
+                               count))
+    return results
+
+
+def bench_dumps(count):
+    results = []
+    for message_type, raw in sorted(SAMPLES.items()):
+        # str() is memoized per message, so each call gets a fresh message
+        messages = [WAMPMessage.loads(raw) for i in xrange(count)]
+        results.append(measure('str.%s' % message_type.str,
+                               lambda i, messages=messages: str(messages[i]),
+                               count))
+    return results
+
+
+class _Sink(object):
+
+    def send(self, message):
+        pass
+
+    def procedure(self, *args):
+        return args
+
+    def callback(self, message):
+        pass
+
+
+def bench_handle(count):
+    sink = _Sink()
+    session = WAMPSession(pubsub=PubSub('benchmark.handle_wamp_message'))
+    session.send_wamp_message = sink.send
+    session.callresult_callback = sink.callback
+    session.callerror_callback = sink.callback
+    session.event_callback = sink.callback
+    session.register_procedure('http://example.com/calc#add', sink.procedure)
+    session.prefixes['calc'] = 'http://example.com/calc#'
+    results = []
+    for message_type, raw in sorted(SAMPLES.items()):
+        message = WAMPMessage.loads(raw)
+        results.append(measure(
+            'handle_wamp_message.%s' % message_type.str,
+            lambda i, message=message: session.handle_wamp_message(message),
+            count, retain=False))
+    session.pubsub.unsubscribe()
+    return results
+
+
+class _Subscriber(object):
+
+    def __init__(self):
+        self.received = 0
+
+    def callback(self, topic, event):
+        self.received += 1
+
+
+def bench_publish(count, fanouts=(1, 100, 10000)):
+    results = []
+    event = json.loads(SAMPLES[WAMPMessageType.EVENT])[2]
+    for fanout in fanouts:
+        pubsub = PubSub('benchmark.publish.%d' % fanout)
+        subscribers = [_Subscriber() for i in xrange(fanout)]
+        for i, subscriber in enumerate(subscribers):
+            pubsub.subscribe(subscriber, i, 'topic', subscriber.callback)
+        publishes = max(10, count // fanout)
+        result = measure('publish.%d' % fanout,
+                         lambda i: pubsub.publish('topic', event),
+                         publishes, retain=False)
+        result['deliveries_per_sec'] = result['ops_per_sec'] * fanout
+        results.append(result)
+        pubsub.unsubscribe()
+    return results
+
+
+def run(count, fanouts=(1, 100, 10000)):
+    results = []
+    for bench in (bench_loads, bench_dumps, bench_handle):
+        results.extend(bench(count))
+    results.extend(bench_publish(count, fanouts))
+    return {'python': sys.version.split()[0], 'count': count,
+            'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """ returns a list of (name, baseline ops/s, current ops/s) regressions """
+    previous = dict((result['name'], result['ops_per_sec'])
+                    for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        before = previous.get(result['name'])
+        if before and result['ops_per_sec'] < before * (1 - tolerance):
+            regressions.append((result['name'], before,
+                                result['ops_per_sec']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=20000,
+                        help="operations per measurement")
+    parser.add_argument('--quick', action='store_true',
+                        help="short run (count=1000), e.g. for smoke tests")
+    parser.add_argument('--output', help="also write the JSON report here")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="JSON report to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    report = run(1000 if args.quick else args.count)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for name, before, after in regressions:
+            sys.stderr.write("REGRESSION %s: %.0f -> %.0f ops/s\n" %
+                             (name, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,491 @@
+"""
+Shares PubSub topics between the processes on one host
+
+A PubSubBroker listens on a Unix-domain socket, and each worker process
+attaches its PubSub service to the broker with a BrokerBackend:
+
+    # once per host (or: python broker.py /tmp/wamp-pubsub.sock)
+    PubSubBroker('/tmp/wamp-pubsub.sock').start()
+
+    # in each worker
+    BrokerBackend('/tmp/wamp-pubsub.sock').attach(PubSub('WAMPSessions'))
+
+The PubSub API is unchanged.  Workers tell the broker which topics (and
+patterns) they have subscriptions for, and send it their publishes; the
+broker forwards each publish once to every other worker with a matching
+subscription, and each worker delivers it to its own subscribers.
+Operations queued while a frame is being written go out together in the
+next frame, so bursts of publishes are batched on the wire.
+
+Frames are lists of operations, encoded with a wampserializer serializer
+(the same one for the broker and its workers) and preceded by their
+length as a 4-byte big-endian unsigned integer:
+
+    ['H', channel]                           hello (sent first)
+    ['S', match, topic]                      subscribe
+    ['U', match, topic]                      unsubscribe
+    ['P', topic, event, exclude, eligible]   publish
+
+Workers share topics with the workers that said hello on the same
+channel (by default, the name of their PubSub service).
+"""
+import argparse
+import os
+import socket
+import stat
+import struct
+import traceback
+from collections import defaultdict, deque
+from threading import Condition, Lock, Thread
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from pubsub import TopicMatch, TopicPattern, _TopicTrie
+from wampserializer import get_serializer
+from wamputil import check_signature
+
+
+_length_header = struct.Struct('!I')
+
+
+def _write_frame(sock, data):
+    sock.sendall(_length_header.pack(len(data)) + data)
+
+
+def _read_frames(rfile, serializer):
+    """ yields the decoded frames read from `rfile` until it is closed """
+    while True:
+        header = rfile.read(_length_header.size)
+        if len(header) < _length_header.size:
+            return
+        size = _length_header.unpack(header)[0]
+        data = rfile.read(size)
+        if len(data) < size:
+            return
+        yield serializer.loads(data)
+
+
+def _topic_key(match, topic):
+    match = TopicMatch(match)
+    if match == TopicMatch.EXACT:
+        return topic
+    return TopicPattern(match, topic)
+
+
+class BrokerBackend(object):
+
+    """
+    connects a PubSub service to a PubSubBroker
+
+    Events from other processes are delivered on this backend's receiving
+    thread, unless `call_soon` is given: it is then called as
+    call_soon(fn, events), from that thread, to have fn(events) called
+    on the application's own thread or event loop (e.g.,
+    loop.call_soon_threadsafe).  A dispatcher (see dispatch.py) also
+    takes the deliveries off the receiving thread.
+
+    If the connection to the broker is lost, the backend closes itself
+    and detaches from the service, which then carries on as a single
+    process; attach a new backend to reconnect.
+    """
+
+    def __init__(self, path, channel=None, serializer=None,
+                 call_soon=None):
+        if call_soon is not None:
+            check_signature(call_soon, num_args=2)
+        self.path = path
+        self.channel = channel
+        self.serializer = get_serializer(serializer)
+        self.call_soon = call_soon
+        self.pubsub = None
+        self._sock = None
+        # appended to without a lock (see _queue), taken by the sender
+        self._outbox = deque()
+        # the sender waits for a byte on _wakeup[0]; _woken is set while
+        # one is on its way, so that a burst of ops sends only one
+        self._wakeup = None
+        self._woken = False
+        self._sending = False
+        self._closed = False
+        # guards _sending, for flush
+        self._lock = Lock()
+        self._sent = Condition(self._lock)
+        self._threads = []
+
+    def attach(self, pubsub):
+        """ connects to the broker and shares `pubsub`'s topics through it """
+        if self.pubsub is not None:
+            raise ValueError("backend is already attached")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self._sock = sock
+        self._wakeup = socket.socketpair()
+        self._wakeup[1].setblocking(False)
+        self.pubsub = pubsub
+        self._queue(['H', self.channel or pubsub.name])
+        # under the service's lock, so that no subscription made or
+        # dropped meanwhile is missed
+        pubsub._lock.acquire()
+        try:
+            pubsub.backend = self
+            for topic in pubsub._subscriptions.keys():
+                self.subscribe_topic(topic)
+        finally:
+            pubsub._unlock()
+        for target in (self._send_loop, self._receive_loop):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self, timeout=None):
+        """
+        detaches from the PubSub service and, once the queued operations
+        have been sent (or `timeout` seconds have passed), disconnects
+        """
+        if self.pubsub is not None and self.pubsub.backend is self:
+            self.pubsub.backend = None
+        self._closed = True
+        self._wake()
+        if self._threads:
+            self._threads[0].join(timeout)
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+    def flush(self, timeout=None):
+        """
+        waits until the queued operations have been written; returns
+        True if none remain
+        """
+        with self._lock:
+            if self._outbox or self._sending:
+                self._wake()
+                self._sent.wait(timeout)
+            return not (self._outbox or self._sending)
+
+    # called by PubSub
+    def subscribe_topic(self, topic):
+        self._queue(self._topic_op('S', topic))
+
+    def unsubscribe_topic(self, topic):
+        self._queue(self._topic_op('U', topic))
+
+    def publish(self, topic, event, exclude, eligible):
+        self._queue(['P', topic, event, list(exclude), list(eligible)])
+
+    @staticmethod
+    def _topic_op(op, topic):
+        if isinstance(topic, TopicPattern):
+            return [op, topic.match, topic.pattern]
+        return [op, TopicMatch.EXACT, topic]
+
+    def _queue(self, op):
+        # no lock: PubSub calls this when a subscriber is collected, i.e.,
+        # from whatever code happened to trigger the collection, which may
+        # hold any lock (deque.append is atomic, and so is waking the
+        # sender with a non-blocking send)
+        if self._closed:
+            return
+        self._outbox.append(op)
+        self._wake()
+
+    def _wake(self):
+        if self._woken or self._wakeup is None:
+            return
+        self._woken = True
+        try:
+            self._wakeup[1].send(b'.')
+        except socket.error:
+            # the sender has already been woken, or has stopped
+            pass
+
+    def _take(self):
+        ops = []
+        try:
+            while True:
+                ops.append(self._outbox.popleft())
+        except IndexError:
+            return ops
+
+    def _send_loop(self):
+        try:
+            while True:
+                self._wakeup[0].recv(4096)
+                # ops queued from here on wake the sender again
+                self._woken = False
+                with self._lock:
+                    ops = self._take()
+                    self._sending = bool(ops)
+                if ops:
+                    try:
+                        data = self._encode(ops)
+                        if data is not None:
+                            _write_frame(self._sock, data)
+                    finally:
+                        with self._lock:
+                            self._sending = False
+                            self._sent.notify_all()
+                if self._closed and not self._outbox:
+                    return
+        except socket.error:
+            if not self._closed:
+                traceback.print_exc()
+        finally:
+            self._disconnected()
+            for end in self._wakeup:
+                end.close()
+
+    def _encode(self, ops):
+        """
+        returns the frame for `ops`, leaving out (and logging) the ones
+        the serializer cannot encode, or None if none are left
+        """
+        try:
+            return self.serializer.dumps(ops)
+        except Exception:
+            pass
+        encodable = []
+        for op in ops:
+            try:
+                self.serializer.dumps([op])
+            except Exception:
+                traceback.print_exc()
+            else:
+                encodable.append(op)
+        if not encodable:
+            return None
+        return self.serializer.dumps(encodable)
+
+    def _receive_loop(self):
+        rfile = self._sock.makefile('rb')
+        try:
+            for ops in _read_frames(rfile, self.serializer):
+                # a frame's publishes are delivered as a batch (see
+                # PubSub.publish_many)
+                events = [(op[1], op[2], frozenset(op[3]), frozenset(op[4]))
+                          for op in ops if op[0] == 'P']
+                try:
+                    if self.call_soon is not None:
+                        self.call_soon(self.pubsub._publish_many, events)
+                    else:
+                        self.pubsub._publish_many(events)
+                except Exception:
+                    traceback.print_exc()
+        except (socket.error, ValueError):
+            if not self._closed:
+                traceback.print_exc()
+        finally:
+            rfile.close()
+            self._disconnected()
+
+    def _disconnected(self):
+        """
+        stops queuing operations, and detaches from the service, once the
+        connection is closed or lost
+        """
+        if self.pubsub is not None and self.pubsub.backend is self:
+            self.pubsub.backend = None
+        self._closed = True
+        self._outbox.clear()
+        self._wake()
+        with self._lock:
+            self._sent.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _Channel(object):
+
+    """ the subscriptions of the workers on one channel """
+
+    __slots__ = ('exact', 'patterns', 'trie')
+
+    def __init__(self):
+        # topic -> set of _BrokerConnection
+        self.exact = dict()
+        # TopicPattern -> set of _BrokerConnection
+        self.patterns = dict()
+        self.trie = _TopicTrie()
+
+    def targets(self, topic):
+        targets = set(self.exact.get(topic, ()))
+        for pattern in self.trie.match(topic):
+            targets.update(self.patterns[pattern])
+        return targets
+
+
+class _BrokerConnection(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.channel = None
+        self.topics = set()
+        self.lock = Lock()
+        with self.server.broker._lock:
+            self.server.broker._connections.add(self)
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            for ops in _read_frames(self.rfile, broker.serializer):
+                broker._handle(self, ops)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            broker._drop(self)
+
+    def send(self, data):
+        with self.lock:
+            _write_frame(self.request, data)
+
+
+class _BrokerServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class PubSubBroker(object):
+
+    """
+    forwards publishes between the BrokerBackends connected to `path`
+
+    NB: a worker that stops reading holds up the workers publishing to
+    it, as each connection's frames are forwarded in turn
+    """
+
+    def __init__(self, path, serializer=None):
+        self.path = path
+        self.serializer = get_serializer(serializer)
+        self._channels = dict()
+        self._connections = set()
+        self._lock = Lock()
+        self._server = None
+
+    def _bind(self):
+        # remove a socket left behind by a broker that did not close
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self._server = _BrokerServer(self.path, _BrokerConnection)
+        self._server.broker = self
+
+    def start(self):
+        """ serves connections on a background thread """
+        self._bind()
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        self._bind()
+        self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        # disconnect the workers, whose backends then detach
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _handle(self, connection, ops):
+        outgoing = defaultdict(list)
+        with self._lock:
+            for op in ops:
+                kind = op[0]
+                if kind == 'P':
+                    if connection.channel is None:
+                        continue
+                    for target in connection.channel.targets(op[1]):
+                        if target is not connection:
+                            outgoing[target].append(op)
+                elif kind == 'S':
+                    self._subscribe(connection, _topic_key(op[1], op[2]))
+                elif kind == 'U':
+                    self._unsubscribe(connection, _topic_key(op[1], op[2]))
+                elif kind == 'H':
+                    connection.channel = self._channels.setdefault(
+                        op[1], _Channel())
+        for target, target_ops in outgoing.iteritems():
+            try:
+                target.send(self.serializer.dumps(target_ops))
+            except socket.error:
+                # the target's own handler drops it
+                pass
+
+    def _subscribe(self, connection, topic):
+        channel = connection.channel
+        if channel is None:
+            return
+        if isinstance(topic, TopicPattern):
+            if topic not in channel.patterns:
+                channel.patterns[topic] = set()
+                channel.trie.add(topic)
+            channel.patterns[topic].add(connection)
+        else:
+            channel.exact.setdefault(topic, set()).add(connection)
+        connection.topics.add(topic)
+
+    def _unsubscribe(self, connection, topic):
+        channel = connection.channel
+        if channel is None:
+            return
+        connection.topics.discard(topic)
+        table = (channel.patterns if isinstance(topic, TopicPattern)
+                 else channel.exact)
+        connections = table.get(topic)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if len(connections) <= 0:
+            del table[topic]
+            if isinstance(topic, TopicPattern):
+                channel.trie.discard(topic)
+
+    def _drop(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+            for topic in list(connection.topics):
+                self._unsubscribe(connection, topic)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PubSub broker")
+    parser.add_argument('path', help="Unix-domain socket to listen on")
+    parser.add_argument('--serializer', default='json')
+    args = parser.parse_args(argv)
+    broker = PubSubBroker(args.path, args.serializer)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+
+
+if __name__ == '__main__':
+    main()
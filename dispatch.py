@@ -0,0 +1,369 @@
+from collections import deque
+from threading import Condition, Lock
+import traceback
+from wamputil import EnumishStr, check_signature
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+class OverflowPolicy(EnumishStr):
+
+    """
+    what a Dispatcher does with a delivery for a key whose queue is full
+
+    DROP_OLDEST: discard the oldest queued delivery to make room
+    DROP_NEWEST: discard the new delivery
+    DISCONNECT: discard the key's queue and every later delivery for
+        it, and call the dispatcher's on_disconnect(key)
+    BLOCK: wait (in `dispatch`) until the queue has room
+    """
+
+    _values = ['DROP_OLDEST',
+               'DROP_NEWEST',
+               'DISCONNECT',
+               'BLOCK']
+
+
+class _KeyState(object):
+
+    """ a key's queue limit and counters """
+
+    __slots__ = ('max_queue', 'overflow', 'dropped', 'conflated',
+                 'max_depth', 'disconnected')
+
+    def __init__(self, max_queue, overflow):
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.dropped = 0
+        self.conflated = 0
+        self.max_depth = 0
+        self.disconnected = False
+
+
+class _Latest(object):
+
+    """
+    a queued delivery that a later one with the same `id` replaces, for
+    as long as it has not started
+    """
+
+    __slots__ = ('id', 'deliver')
+
+    def __init__(self, id, deliver):
+        self.id = id
+        self.deliver = deliver
+
+    def __call__(self):
+        self.deliver()
+
+
+class Dispatcher(object):
+
+    """
+    runs deliveries off the caller's stack
+
+    `dispatch(key, deliver)` queues the zero-argument callable `deliver`
+    and returns immediately.  Deliveries queued under the same key (for
+    PubSub, the subscriber key) are run one at a time, in the order they
+    were queued; deliveries under different keys may run concurrently,
+    or interleaved.
+
+    If `max_queue` is given, at most that many deliveries are queued per
+    key, and `overflow` (an OverflowPolicy) decides what happens to the
+    rest; `configure` sets a different limit for a single key.
+
+    A delivery dispatched with `latest` (any hashable value) replaces a
+    delivery queued earlier under the same key and `latest` that has not
+    yet started, keeping its place in the queue; this conflates bursts
+    of updates into the newest one, for as long as the key's deliveries
+    are backed up.
+
+    `stats` reports a key's queue depth and dropped and conflated
+    deliveries.  A key's limit
+    and counters are kept until `forget(key)`, which PubSub calls when
+    the key's last subscription is removed.
+
+    Subclasses implement `_schedule(key)`, which arranges for
+    `_drain(key)` to be called, and `flush`, which waits for every
+    queued delivery to finish.
+    """
+
+    _blocking = True
+
+    def __init__(self, max_queue=None, overflow=OverflowPolicy.DROP_OLDEST,
+                 on_disconnect=None):
+        # key -> deque of deliveries; a key is present while a drain for
+        # it is scheduled or running
+        self._queues = dict()
+        # key -> _KeyState
+        self._state = dict()
+        # (key, latest) -> queued _Latest
+        self._latest = dict()
+        self.max_queue = self._check_max_queue(max_queue)
+        self.overflow = self._check_overflow(overflow)
+        self.on_disconnect = on_disconnect
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._space = Condition(self._lock)
+        self._blocked = 0
+
+    def _check_max_queue(self, max_queue):
+        if max_queue is not None and max_queue < 1:
+            raise ValueError("max_queue must be at least 1")
+        return max_queue
+
+    def _check_overflow(self, overflow):
+        overflow = OverflowPolicy(overflow)
+        if overflow == OverflowPolicy.BLOCK and not self._blocking:
+            raise ValueError("%s does not support the BLOCK policy" %
+                             self.__class__.__name__)
+        return overflow
+
+    def configure(self, key, max_queue=None, overflow=None):
+        """
+        sets the queue limit and overflow policy for `key` (by default,
+        the dispatcher's)
+        """
+        max_queue = self._check_max_queue(max_queue)
+        overflow = self._check_overflow(overflow or self.overflow)
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                self._state[key] = _KeyState(max_queue, overflow)
+            else:
+                state.max_queue = max_queue
+                state.overflow = overflow
+
+    def forget(self, key):
+        """ discards the limit and counters kept for `key` """
+        # no lock: this can be called from a weakref callback, i.e., from
+        # whatever code happened to trigger a collection (and dict.pop is
+        # atomic)
+        self._state.pop(key, None)
+
+    def stats(self, key):
+        """
+        returns {'depth': deliveries queued now, 'max_depth': the most
+        ever queued at once, 'dropped': deliveries discarded by the
+        overflow policy, 'conflated': deliveries replaced by a later one,
+        'disconnected': True after DISCONNECT} for `key`
+        """
+        with self._lock:
+            state = self._state.get(key) or _KeyState(None, None)
+            return {'depth': len(self._queues.get(key, ())),
+                    'max_depth': state.max_depth,
+                    'dropped': state.dropped,
+                    'conflated': state.conflated,
+                    'disconnected': state.disconnected}
+
+    @property
+    def pending(self):
+        """ number of deliveries queued but not yet started """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.itervalues())
+
+    def dispatch(self, key, deliver, latest=None):
+        disconnect = schedule = False
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                state = self._state[key] = _KeyState(self.max_queue,
+                                                     self.overflow)
+            if state.disconnected:
+                state.dropped += 1
+                return
+            if latest is not None:
+                latest = (key, latest)
+                queued = self._latest.get(latest)
+                if queued is not None:
+                    queued.deliver = deliver
+                    state.conflated += 1
+                    return
+                deliver = _Latest(latest, deliver)
+            queue = self._queues.get(key)
+            if (queue is not None and state.max_queue is not None and
+                    len(queue) >= state.max_queue):
+                overflow = state.overflow
+                if overflow == OverflowPolicy.DROP_OLDEST:
+                    self._dequeued(queue.popleft())
+                    state.dropped += 1
+                elif overflow == OverflowPolicy.DROP_NEWEST:
+                    state.dropped += 1
+                    return
+                elif overflow == OverflowPolicy.BLOCK:
+                    queue = self._wait_for_space(key, state)
+                else:
+                    state.dropped += len(queue) + 1
+                    state.disconnected = disconnect = True
+                    for dropped in queue:
+                        self._dequeued(dropped)
+                    queue.clear()
+            if not disconnect:
+                if queue is not None:
+                    queue.append(deliver)
+                    if len(queue) > state.max_depth:
+                        state.max_depth = len(queue)
+                else:
+                    self._queues[key] = deque((deliver,))
+                    state.max_depth = max(state.max_depth, 1)
+                    schedule = True
+                if latest is not None:
+                    self._latest[latest] = deliver
+        if schedule:
+            self._schedule(key)
+        elif disconnect:
+            self._disconnected(key)
+
+    def _dequeued(self, deliver):
+        if type(deliver) is _Latest and \
+                self._latest.get(deliver.id) is deliver:
+            del self._latest[deliver.id]
+
+    def _wait_for_space(self, key, state):
+        """
+        waits (with the lock held) until the queue for `key` has room;
+        returns the queue, or None if it was drained and forgotten
+        """
+        self._blocked += 1
+        try:
+            while True:
+                self._space.wait()
+                queue = self._queues.get(key)
+                if (queue is None or state.max_queue is None or
+                        len(queue) < state.max_queue):
+                    return queue
+        finally:
+            self._blocked -= 1
+
+    def _disconnected(self, key):
+        if self.on_disconnect is not None:
+            self._run(lambda: self.on_disconnect(key))
+
+    def _next(self, key):
+        """
+        returns the next delivery queued under `key`, or None (after
+        forgetting `key`) if there are none
+        """
+        with self._lock:
+            queue = self._queues[key]
+            if queue:
+                if self._blocked:
+                    self._space.notify_all()
+                deliver = queue.popleft()
+                self._dequeued(deliver)
+                return deliver
+            del self._queues[key]
+            if self._blocked:
+                self._space.notify_all()
+            if not self._queues:
+                self._idle.notify_all()
+                self._on_idle()
+            return None
+
+    def _run(self, deliver):
+        try:
+            deliver()
+        except Exception:
+            traceback.print_exc()
+
+    def _on_idle(self):
+        pass
+
+    def _schedule(self, key):
+        raise NotImplementedError
+
+    def _drain(self, key):
+        raise NotImplementedError
+
+
+class ThreadPoolDispatcher(Dispatcher):
+
+    """
+    runs deliveries on a concurrent.futures executor
+
+    A worker runs a key's deliveries until its queue is empty, so a
+    single slow subscriber occupies at most one worker.
+
+    NB: with the BLOCK overflow policy, a delivery that publishes to a
+    subscriber whose queue is full waits on a worker thread, which can
+    deadlock a small pool
+    """
+
+    def __init__(self, executor=None, max_workers=4, **kwargs):
+        super(ThreadPoolDispatcher, self).__init__(**kwargs)
+        if executor is None:
+            if ThreadPoolExecutor is None:
+                raise ValueError("an executor is required when "
+                                 "concurrent.futures is not installed")
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.executor = executor
+
+    def _schedule(self, key):
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        deliver = self._next(key)
+        while deliver is not None:
+            self._run(deliver)
+            deliver = self._next(key)
+
+    def flush(self, timeout=None):
+        """
+        blocks until every queued delivery has run, or until `timeout`
+        seconds have passed; returns True if nothing remains queued
+        """
+        with self._lock:
+            if self._queues:
+                self._idle.wait(timeout)
+            return not self._queues
+
+
+class LoopDispatcher(Dispatcher):
+
+    """
+    runs deliveries as callbacks on an event loop
+
+    `call_soon` schedules a callback on the loop, and is called as
+    call_soon(fn, arg); it must be safe to call from any thread that
+    publishes (e.g., Tornado's IOLoop.add_callback, or an asyncio loop's
+    call_soon_threadsafe).
+
+    Each callback runs at most one delivery, so a key with a long queue
+    does not hold up the others.  The BLOCK overflow policy is not
+    supported, as it would block the loop.
+    """
+
+    _blocking = False
+
+    def __init__(self, call_soon, **kwargs):
+        check_signature(call_soon, num_args=2)
+        super(LoopDispatcher, self).__init__(**kwargs)
+        self.call_soon = call_soon
+        self._waiters = []
+
+    def _schedule(self, key):
+        self.call_soon(self._drain, key)
+
+    def _drain(self, key):
+        deliver = self._next(key)
+        if deliver is not None:
+            self._run(deliver)
+            self.call_soon(self._drain, key)
+
+    def _on_idle(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            self.call_soon(self._run, waiter)
+
+    def flush(self, callback):
+        """
+        calls callback() on the loop once every queued delivery has run
+        """
+        with self._lock:
+            if self._queues:
+                self._waiters.append(callback)
+                return
+        self.call_soon(self._run, callback)
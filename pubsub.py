@@ -1,14 +1,191 @@
-from collections import namedtuple, defaultdict
-from weakref import WeakValueDictionary
+from collections import namedtuple, defaultdict, deque
+from functools import partial
+from threading import Lock
+from weakref import ref
 from wamputil import (none_or_equal, iterablate, check_signature,
-                      WeaklyBoundCallable)
+                      WeaklyBoundCallable, EnumishStr, LRUCache)
+
+
+class TopicMatch(EnumishStr):
+
+    """
+    how a subscription's topic is matched against published topics
+
+    EXACT: the topics are equal
+    PREFIX: the published topic starts with the subscription's topic
+        (a trailing '*', as in 'http://example.com/stocks/*', is ignored)
+    WILDCARD: the topics have the same '/'-separated segments, except
+        where the subscription's segment is '*', which matches any one
+        segment (e.g., 'http://example.com/*/price')
+    """
+
+    _values = ['EXACT',
+               'PREFIX',
+               'WILDCARD']
+
+
+# the key under which PREFIX and WILDCARD subscriptions are stored
+TopicPattern = namedtuple('TopicPattern', 'match pattern')
+
+
+class _TopicNode(object):
+
+    __slots__ = ('children', 'wildcard', 'prefixes', 'pattern')
+
+    def __init__(self):
+        self.children = dict()
+        self.wildcard = None
+        self.prefixes = dict()
+        self.pattern = None
+
+    def __nonzero__(self):
+        return bool(self.children or self.wildcard or self.prefixes or
+                    self.pattern)
+
+
+class _TopicTrie(object):
+
+    """
+    the PREFIX and WILDCARD topic patterns that have subscriptions,
+    indexed by '/'-separated segment
+
+    `match` walks one level per segment of the published topic, so its
+    cost grows with the topic's depth (and the number of wildcards that
+    apply at each level) rather than with the number of patterns
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _path(self, pattern, create=False):
+        """
+        returns the nodes along `pattern`, and the trailing partial
+        segment of a PREFIX pattern; None if the path does not exist
+        """
+        segments = pattern.pattern.split('/')
+        partial = None
+        if pattern.match == TopicMatch.PREFIX:
+            partial = segments.pop()
+        nodes = [self._root]
+        for segment in segments:
+            node = nodes[-1]
+            if pattern.match == TopicMatch.WILDCARD and segment == '*':
+                child = node.wildcard
+                if child is None and create:
+                    child = node.wildcard = _TopicNode()
+            else:
+                child = node.children.get(segment)
+                if child is None and create:
+                    child = node.children[segment] = _TopicNode()
+            if child is None:
+                return None, None
+            nodes.append(child)
+        return nodes, partial
+
+    def add(self, pattern):
+        nodes, partial = self._path(pattern, create=True)
+        node = nodes[-1]
+        if partial is not None:
+            if partial not in node.prefixes:
+                node.prefixes[partial] = pattern
+                self._count += 1
+        elif node.pattern is None:
+            node.pattern = pattern
+            self._count += 1
+
+    def discard(self, pattern):
+        nodes, partial = self._path(pattern)
+        if nodes is None:
+            return
+        node = nodes[-1]
+        if partial is not None:
+            if node.prefixes.pop(partial, None) is None:
+                return
+        elif node.pattern is None:
+            return
+        else:
+            node.pattern = None
+        self._count -= 1
+        # prune the nodes that no longer lead to a pattern
+        segments = pattern.pattern.split('/')
+        for depth in range(len(nodes) - 1, 0, -1):
+            if nodes[depth]:
+                break
+            parent = nodes[depth - 1]
+            if parent.wildcard is nodes[depth]:
+                parent.wildcard = None
+            else:
+                del parent.children[segments[depth - 1]]
+
+    def match(self, topic):
+        """ returns the patterns that match `topic` """
+        matches = []
+        nodes = [self._root]
+        for segment in topic.split('/'):
+            children = []
+            for node in nodes:
+                for partial, pattern in node.prefixes.iteritems():
+                    if segment.startswith(partial):
+                        matches.append(pattern)
+                child = node.children.get(segment)
+                if child is not None:
+                    children.append(child)
+                if node.wildcard is not None:
+                    children.append(node.wildcard)
+            nodes = children
+            if not nodes:
+                return matches
+        for node in nodes:
+            if node.pattern is not None:
+                matches.append(node.pattern)
+        return matches
+
+
+class Publication(object):
+
+    """
+    a single event being delivered to the subscribers of a topic
+
+    Subscriptions made with `publication=True` are called with the
+    Publication rather than with (topic, event), which lets every
+    recipient of the event share work through `memo`
+    """
+
+    def __init__(self, topic, event):
+        self.topic = topic
+        self.event = event
+        self._memo = dict()
+
+    def memo(self, factory):
+        """
+        returns factory(topic, event), calling factory at most once per
+        publication
+        """
+        try:
+            return self._memo[factory]
+        except KeyError:
+            value = self._memo[factory] = factory(self.topic, self.event)
+            return value
 
 
 class Subscription(object):
 
-    def __init__(self, key, callback):
+    def __init__(self, key, callback, publication=False, on_dead=None,
+                 batch=None):
         self.key = key
-        self.callback = WeaklyBoundCallable(callback)
+        self.callback = WeaklyBoundCallable(callback, on_dead)
+        self.publication = publication
+        self.batch = WeaklyBoundCallable(batch) if batch is not None else None
+
+    def deliver(self, publication):
+        if self.publication:
+            self.callback(publication)
+        else:
+            self.callback(publication.topic, publication.event)
 
     def __eq__(self, other):
         return (self.__class__ == other.__class__ and
@@ -22,11 +199,32 @@ class Subscription(object):
         return self.key.__hash__() ^ self.callback.__hash__()
 
 
+class _SubscriberIndex(object):
+
+    """
+    the subscriptions made by one subscriber, by topic, so that they can
+    be found without scanning every topic (e.g., when a session closes)
+
+    `keys` counts the subscriptions made under each key
+    """
+
+    __slots__ = ('ref', 'topics', 'keys')
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.topics = dict()
+        self.keys = dict()
+
+
 class PubSub(object):
 
     """
     Provides publish-subscribe service between local instances
     Compatible with (most) WAMP semantics
+
+    A service may be used from several threads (e.g., a BrokerBackend's
+    receiving thread): its subscriptions are changed and looked up under
+    a lock, while callbacks are called without it.
     """
 
     _instances = dict()
@@ -38,54 +236,425 @@ class PubSub(object):
         """
         if name not in cls._instances:
             cls._instances[name] = super(PubSub, cls).__new__(cls)
-            subs = defaultdict(WeakValueDictionary)
-            cls._instances[name]._subscriptions = subs
+            # topic -> Subscription -> weakref to its subscriber (the ref
+            # in the subscriber's _SubscriberIndex); topics are removed as
+            # soon as they have no subscriptions, so that publishing to a
+            # topic nobody subscribes to costs one dict miss
+            cls._instances[name]._subscriptions = dict()
+            # id(subscriber) -> _SubscriberIndex
+            cls._instances[name]._subscribers = dict()
+            # key -> set of id(subscriber) with subscriptions under key
+            cls._instances[name]._keys = dict()
+            # topic -> key -> set of Subscription, for `eligible` filters
+            cls._instances[name]._topic_keys = dict()
+            cls._instances[name]._patterns = _TopicTrie()
+            cls._instances[name].dispatcher = None
+            # topic -> event key function (or None), for conflate()
+            cls._instances[name]._conflated = dict()
+            # topic -> (event, exclude, eligible), if retain() is enabled
+            cls._instances[name]._retained = None
+            cls._instances[name].name = name
+            # shares publishes with other processes; see broker.py
+            cls._instances[name].backend = None
+            # see pubsubmetrics.py
+            cls._instances[name].metrics = None
+            # guards the structures above; see _unlock
+            cls._instances[name]._lock = Lock()
+            # cleanups for collected subscribers, run under the lock
+            cls._instances[name]._dead = deque()
         return cls._instances[name]
 
-    def subscribe(self, subscriber, key, topic, callback):
-        check_signature(callback, num_args=2)
-        sub = Subscription(key, callback)
-        self._subscriptions[topic][sub] = subscriber
+    def _unlock(self):
+        """
+        releases the lock, after running the cleanups queued (by
+        _collected) while it was held
+        """
+        while True:
+            while self._dead:
+                try:
+                    self._dead.popleft()()
+                except Exception as e:
+                    import traceback
+                    traceback.print_exc(e)
+            self._lock.release()
+            # a cleanup queued after the check found the lock still held
+            if not self._dead or not self._lock.acquire(False):
+                return
 
-    def subscriptions(self, subscriber=None, key=None, topic=None,
-                      callback=None):
-        report = defaultdict(list)
-        if topic is not None:
-            topics = iterablate(topic)
-        else:
-            topics = self._subscriptions.keys()
+    def _collected(self, cleanup):
+        """
+        runs `cleanup` now if the service is not locked, or else when it
+        is unlocked
+
+        For weakref callbacks, which run on whatever thread triggered the
+        collection, possibly in the middle of a locked section (so they
+        must not wait for the lock)
+        """
+        self._dead.append(cleanup)
+        if self._lock.acquire(False):
+            self._unlock()
+
+    @staticmethod
+    def _topic_key(topic, match):
+        """ the key in _subscriptions for `topic` matched by `match` """
+        match = TopicMatch(match)
+        if match == TopicMatch.EXACT:
+            return topic
+        if match == TopicMatch.PREFIX and topic.endswith('*'):
+            topic = topic[:-1]
+        return TopicPattern(match, topic)
+
+    def subscribe(self, subscriber, key, topic, callback, publication=False,
+                  match=TopicMatch.EXACT, batch=None):
+        """
+        callback: called as callback(topic, event) for each event published
+        to `topic`, or as callback(publication) if `publication` is True
+        match: a TopicMatch; for PREFIX and WILDCARD, `topic` is a pattern
+        and callback receives the topics that were actually published
+        batch: if given, called as batch(publications) instead of
+        `callback`, once per `key` and batch callback, with the events
+        published by a call to publish_many
+        """
+        check_signature(callback, num_args=1 if publication else 2)
+        if batch is not None:
+            check_signature(batch, num_args=1)
+        topic = self._topic_key(topic, match)
+        sub = Subscription(key, callback, publication,
+                           partial(self._reap, topic), batch)
+        self._lock.acquire()
+        try:
+            if isinstance(topic, TopicPattern):
+                self._patterns.add(topic)
+            topic_subs = self._subscriptions.get(topic)
+            if topic_subs is None:
+                # read once: a broker backend detaches itself from another
+                # thread when its connection is lost
+                backend = self.backend
+                if backend is not None:
+                    backend.subscribe_topic(topic)
+                topic_subs = self._subscriptions[topic] = dict()
+            previous = topic_subs.get(sub)
+            if previous is not None and previous() is not subscriber:
+                self._unindex(topic, sub, previous())
+            topic_subs[sub] = self._index(topic, sub, subscriber).ref
+            retained = self._retained_for(topic, sub)
+        finally:
+            self._unlock()
+        if retained:
+            self._deliver_retained(sub, retained)
+
+    def _index(self, topic, sub, subscriber):
+        index = self._subscribers.get(id(subscriber))
+        if index is None:
+            forget = partial(self._forget, id(subscriber))
+            index = _SubscriberIndex(ref(subscriber, forget))
+            self._subscribers[id(subscriber)] = index
+        subs = index.topics.setdefault(topic, set())
+        if sub in subs:
+            return index
+        subs.add(sub)
+        topic_keys = self._topic_keys.setdefault(topic, dict())
+        topic_keys.setdefault(sub.key, set()).add(sub)
+        count = index.keys.get(sub.key, 0)
+        index.keys[sub.key] = count + 1
+        if count == 0:
+            self._keys.setdefault(sub.key, set()).add(id(subscriber))
+        return index
+
+    def _unindex(self, topic, sub, subscriber):
+        index = self._subscribers.get(id(subscriber))
+        if index is None:
+            return
+        subs = index.topics.get(topic)
+        if subs is None or sub not in subs:
+            return
+        subs.discard(sub)
+        if len(subs) <= 0:
+            del index.topics[topic]
+        self._unindex_topic_key(topic, sub)
+        index.keys[sub.key] -= 1
+        if index.keys[sub.key] <= 0:
+            del index.keys[sub.key]
+            self._unindex_key(sub.key, id(subscriber))
+        if len(index.topics) <= 0:
+            del self._subscribers[id(subscriber)]
+
+    def _unindex_topic_key(self, topic, sub):
+        topic_keys = self._topic_keys.get(topic)
+        if topic_keys is None:
+            return
+        subs = topic_keys.get(sub.key)
+        if subs is not None:
+            subs.discard(sub)
+            if len(subs) <= 0:
+                del topic_keys[sub.key]
+                if len(topic_keys) <= 0:
+                    del self._topic_keys[topic]
+
+    def _unindex_key(self, key, subscriber_id):
+        subscriber_ids = self._keys.get(key)
+        if subscriber_ids is not None:
+            subscriber_ids.discard(subscriber_id)
+            if len(subscriber_ids) <= 0:
+                del self._keys[key]
+                if self.dispatcher is not None:
+                    self.dispatcher.forget(key)
+
+    def _forget(self, subscriber_id, subscriber_ref):
+        # weakref callback for a subscriber
+        self._collected(partial(self._drop_subscriber, subscriber_id,
+                                subscriber_ref))
+
+    def _drop_subscriber(self, subscriber_id, subscriber_ref):
+        """
+        removes the subscriptions of a subscriber that has been collected,
+        and the topics left without any
+        """
+        index = self._subscribers.get(subscriber_id)
+        if index is None or index.ref is not subscriber_ref:
+            return
+        del self._subscribers[subscriber_id]
+        for key in index.keys:
+            self._unindex_key(key, subscriber_id)
+        for topic, subs in index.topics.iteritems():
+            for sub in subs:
+                self._unindex_topic_key(topic, sub)
+                self._discard(topic, sub, subscriber_ref)
+
+    def _reap(self, topic, callback):
+        # the on_dead callback of a subscription's WeaklyBoundCallable
+        self._collected(partial(self._drop_callback, topic, callback))
+
+    def _drop_callback(self, topic, callback):
+        """
+        removes the subscription to `topic` whose (weakly bound) callback
+        is `callback`, after the callback's bound object was collected
+        """
+        topic_subs = self._subscriptions.get(topic)
+        if topic_subs is None:
+            return
+        for sub, subscriber_ref in topic_subs.items():
+            if sub.callback is callback:
+                self._remove(topic, sub, subscriber_ref())
+
+    def _remove(self, topic, sub, subscriber):
+        topic_subs = self._subscriptions.get(topic)
+        if topic_subs is not None and topic_subs.get(sub) is not None:
+            self._discard(topic, sub, topic_subs[sub])
+        self._unindex(topic, sub, subscriber)
+
+    def _discard(self, topic, sub, subscriber_ref):
+        """
+        removes `sub` from `topic` if it belongs to the subscriber behind
+        `subscriber_ref`, and then the topic if it has no subscriptions
+        """
+        topic_subs = self._subscriptions.get(topic)
+        if topic_subs is None or topic_subs.get(sub) is not subscriber_ref:
+            return
+        del topic_subs[sub]
+        if len(topic_subs) <= 0:
+            del self._subscriptions[topic]
+            if isinstance(topic, TopicPattern):
+                self._patterns.discard(topic)
+            backend = self.backend
+            if backend is not None:
+                backend.unsubscribe_topic(topic)
+
+    def _find(self, subscriber=None, key=None, topic=None, callback=None):
+        """
+        returns a list of (topic, subscription, subscriber) for the
+        subscriptions matching every filter that is not None
+
+        When `subscriber` or `key` is given, only that subscriber's (or
+        key's) own subscriptions are examined, via the subscriber index;
+        otherwise the requested topics (default: all) are scanned
+        """
+        topics = None if topic is None else set(iterablate(topic))
         if callback is not None:
             callback = WeaklyBoundCallable(callback)
-        for topic in topics:
-            topic_subs = self._subscriptions[topic]
-            for sub in topic_subs.keys():
-                match = none_or_equal(subscriber, topic_subs[sub]) and \
-                    none_or_equal(key, sub.key) and \
-                    none_or_equal(callback, sub.callback)
-                if match:
-                    record = (topic_subs[sub], sub.key,
-                              sub.callback.reverted())
-                    report[topic].append(record)
+        candidates = []
+        if subscriber is not None or key is not None:
+            if subscriber is not None:
+                subscriber_ids = [id(subscriber)]
+            else:
+                subscriber_ids = list(self._keys.get(key, ()))
+            for subscriber_id in subscriber_ids:
+                index = self._subscribers.get(subscriber_id)
+                owner = index.ref() if index is not None else None
+                if owner is None or (subscriber is not None and
+                                     owner is not subscriber):
+                    continue
+                for sub_topic, subs in index.topics.iteritems():
+                    if topics is None or sub_topic in topics:
+                        candidates.extend((sub_topic, sub, index.ref)
+                                          for sub in subs)
+        else:
+            if topics is None:
+                topics = self._subscriptions.keys()
+            for sub_topic in topics:
+                topic_subs = self._subscriptions.get(sub_topic)
+                if topic_subs is not None:
+                    candidates.extend((sub_topic, sub, subscriber_ref)
+                                      for sub, subscriber_ref
+                                      in topic_subs.items())
+        found = []
+        for sub_topic, sub, subscriber_ref in candidates:
+            topic_subs = self._subscriptions.get(sub_topic)
+            owner = subscriber_ref()
+            if topic_subs is None or owner is None or \
+                    topic_subs.get(sub) is not subscriber_ref:
+                continue
+            if none_or_equal(key, sub.key) and \
+                    none_or_equal(callback, sub.callback):
+                found.append((sub_topic, sub, owner))
+        return found
+
+    def subscriptions(self, subscriber=None, key=None, topic=None,
+                      callback=None, match=TopicMatch.EXACT):
+        """
+        returns {topic: [(subscriber, key, callback), ...]} for the
+        subscriptions matching every filter that is not None; PREFIX and
+        WILDCARD subscriptions are reported under their TopicPattern
+        """
+        if topic is not None:
+            topic = [self._topic_key(t, match) for t in iterablate(topic)]
+        self._lock.acquire()
+        try:
+            found = self._find(subscriber, key, topic, callback)
+        finally:
+            self._unlock()
+        report = defaultdict(list)
+        for topic, sub, owner in found:
+            report[topic].append((owner, sub.key, sub.callback.reverted()))
         return report
 
     def unsubscribe(self, subscriber=None, key=None, topic=None,
-                    callback=None):
+                    callback=None, match=TopicMatch.EXACT):
         if topic is not None:
-            topics = iterablate(topic)
+            topic = [self._topic_key(t, match) for t in iterablate(topic)]
+        self._lock.acquire()
+        try:
+            for topic, sub, owner in self._find(subscriber, key, topic,
+                                                callback):
+                self._remove(topic, sub, owner)
+        finally:
+            self._unlock()
+
+    def retain(self, max_topics=1024):
+        """
+        keeps the last event published to each topic and delivers it to
+        new subscriptions as soon as they are made (subject to the
+        `exclude` and `eligible` keys it was published with)
+
+        At most `max_topics` events are kept; the least recently
+        published topics are forgotten first.  retain(0) stops retaining
+        and discards the retained events.
+        """
+        self._lock.acquire()
+        try:
+            if max_topics > 0:
+                retained = LRUCache(max_topics)
+                if self._retained is not None:
+                    for topic in self._retained.keys():
+                        retained[topic] = self._retained.get(topic)
+                self._retained = retained
+            else:
+                self._retained = None
+        finally:
+            self._unlock()
+
+    def retained(self, topic):
+        """ returns the event retained for `topic`, or None """
+        self._lock.acquire()
+        try:
+            if self._retained is None:
+                return None
+            retained = self._retained.get(topic)
+        finally:
+            self._unlock()
+        return retained[0] if retained is not None else None
+
+    def _retained_for(self, topic, subscription):
+        """
+        returns the Publications of the retained events that a new
+        `subscription` to `topic` is to receive (called with the lock held)
+        """
+        if self._retained is None:
+            return []
+        if isinstance(topic, TopicPattern):
+            pattern = _TopicTrie()
+            pattern.add(topic)
+            topics = [retained_topic
+                      for retained_topic in self._retained.keys()
+                      if pattern.match(retained_topic)]
         else:
-            topics = self._subscriptions.keys()
-        if callback is not None:
-            callback = WeaklyBoundCallable(callback)
+            topics = [topic]
+        publications = []
         for topic in topics:
-            topic_subs = self._subscriptions[topic]
-            for sub in topic_subs.keys():
-                remove = none_or_equal(subscriber, topic_subs[sub]) and \
-                    none_or_equal(key, sub.key) and \
-                    none_or_equal(callback, sub.callback)
-                if remove:
-                    del topic_subs[sub]
-            if len(topic_subs) <= 0:
-                del self._subscriptions[topic]
+            retained = self._retained.get(topic)
+            if retained is None:
+                continue
+            event, exclude, eligible = retained
+            if subscription.key in exclude or \
+                    (eligible and subscription.key not in eligible):
+                continue
+            publications.append(Publication(topic, event))
+        return publications
+
+    def _deliver_retained(self, subscription, publications):
+        for publication in publications:
+            if self.dispatcher is not None:
+                self.dispatcher.dispatch(subscription.key,
+                                         partial(subscription.deliver,
+                                                 publication))
+                continue
+            try:
+                subscription.deliver(publication)
+            except Exception as e:
+                import traceback
+                traceback.print_exc(e)
+
+    def conflate(self, topic, key=None):
+        """
+        delivers only the latest event published to `topic` to each
+        subscription, rather than every event
+
+        If `key` is given, the latest event is kept per key(event) (e.g.,
+        per symbol on a price topic).  Events are conflated while they
+        wait in the service's dispatcher, i.e., while a subscriber's
+        deliveries are backed up; without a dispatcher, every event is
+        delivered as it is published.
+        """
+        self._conflated[topic] = key
+
+    def unconflate(self, topic):
+        """ reverts `conflate(topic)` """
+        self._conflated.pop(topic, None)
+
+    def _recipients(self, topic, exclude, eligible):
+        """
+        returns the subscriptions stored under `topic` whose keys are not
+        in `exclude` and, if `eligible` is not empty, are in `eligible`
+
+        When there are fewer eligible keys than subscriptions, only the
+        eligible keys' subscriptions are looked up
+        """
+        topic_subs = self._subscriptions.get(topic)
+        if not topic_subs:
+            return ()
+        if eligible and len(eligible) < len(topic_subs):
+            topic_keys = self._topic_keys.get(topic, {})
+            return [subscription for key in eligible
+                    if key not in exclude
+                    for subscription in topic_keys.get(key, ())]
+        if eligible:
+            return [subscription for subscription in topic_subs.keys()
+                    if subscription.key in eligible and
+                    subscription.key not in exclude]
+        if exclude:
+            return [subscription for subscription in topic_subs.keys()
+                    if subscription.key not in exclude]
+        return topic_subs.keys()
 
     def publish(self, topic, event, exclude=None, eligible=None):
         """
@@ -96,18 +665,181 @@ class PubSub(object):
         has no knowledge of 'me'.  If you want to exclude the publisher
         from receiving the event, include the publisher's key in the
         `exclude` parameter
+
+        If the service has a `dispatcher` (see dispatch.py), deliveries are
+        handed to it and publish returns without waiting for them.  If it
+        has a `backend`, the event is also handed to the backend, for the
+        subscribers in other processes
+        """
+        exclude = frozenset(iterablate(exclude))
+        eligible = frozenset(iterablate(eligible))
+        self._publish(topic, event, exclude, eligible)
+        backend = self.backend
+        if backend is not None:
+            backend.publish(topic, event, exclude, eligible)
+
+    def publish_many(self, events):
+        """
+        publishes each (topic, event[, exclude[, eligible]]) in `events`,
+        in order
+
+        Subscriptions made with a `batch` callback receive all of their
+        key's events from `events` in one call, as a list of
+        Publications, after the other subscriptions have received theirs.
+        With a dispatcher, events on conflated topics (see conflate) are
+        delivered one at a time instead, so that they are conflated.
+        """
+        normalized = []
+        for entry in events:
+            exclude = frozenset(iterablate(entry[2] if len(entry) > 2
+                                           else None))
+            eligible = frozenset(iterablate(entry[3] if len(entry) > 3
+                                            else None))
+            normalized.append((entry[0], entry[1], exclude, eligible))
+        self._publish_many(normalized)
+        backend = self.backend
+        if backend is not None:
+            for topic, event, exclude, eligible in normalized:
+                backend.publish(topic, event, exclude, eligible)
+
+    def _publish_many(self, events):
+        """
+        delivers each (topic, event, exclude, eligible) in `events` to this
+        process's subscribers; `exclude` and `eligible` are sets of keys
+        """
+        batches = dict()
+        order = []
+        for topic, event, exclude, eligible in events:
+            self._lock.acquire()
+            try:
+                subscriptions, publication = self._prepare(topic, event,
+                                                           exclude, eligible)
+            finally:
+                self._unlock()
+            if publication is None:
+                self._unheard(topic)
+                continue
+            # a batch is dispatched as a whole, so it cannot be conflated
+            conflated = (self.dispatcher is not None and
+                         topic in self._conflated)
+            single = []
+            batched = []
+            for subscription in subscriptions:
+                if subscription.batch is None or conflated:
+                    single.append(subscription)
+                else:
+                    batched.append(subscription)
+            start = self._deliver(topic, event, single, publication,
+                                  len(subscriptions))
+            for subscription in batched:
+                batch = (subscription.key, subscription.batch)
+                entries = batches.get(batch)
+                if entries is None:
+                    entries = batches[batch] = []
+                    order.append(batch)
+                # with the publish's start time, if it is being timed
+                entries.append((publication, start))
+        for batch in order:
+            key, callback = batch
+            if self.dispatcher is not None:
+                self.dispatcher.dispatch(key, partial(self._deliver_batch,
+                                                      key, callback,
+                                                      batches[batch]))
+                continue
+            try:
+                self._deliver_batch(key, callback, batches[batch])
+            except Exception as e:
+                import traceback
+                traceback.print_exc(e)
+
+    def _deliver_batch(self, key, callback, entries):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.deliver_batch(key, callback, entries)
+        else:
+            callback([publication for publication, start in entries])
+
+    def _prepare(self, topic, event, exclude, eligible):
+        """
+        returns the subscriptions that are to receive `event`, and its
+        Publication (None, if there are no such subscriptions);
+        `exclude` and `eligible` are sets of keys (called with the lock
+        held)
+        """
+        if self._retained is not None:
+            self._retained[topic] = (event, exclude, eligible)
+        subscriptions = self._recipients(topic, exclude, eligible)
+        if self._patterns:
+            for pattern in self._patterns.match(topic):
+                if not isinstance(subscriptions, list):
+                    subscriptions = list(subscriptions)
+                subscriptions.extend(self._recipients(pattern, exclude,
+                                                      eligible))
+        if not subscriptions:
+            return subscriptions, None
+        return subscriptions, Publication(topic, event)
+
+    def _publish(self, topic, event, exclude, eligible):
+        """
+        delivers `event` to this process's subscribers; `exclude` and
+        `eligible` are sets of keys
+        """
+        self._lock.acquire()
+        try:
+            subscriptions, publication = self._prepare(topic, event, exclude,
+                                                       eligible)
+        finally:
+            self._unlock()
+        if publication is None:
+            self._unheard(topic)
+            return
+        self._deliver(topic, event, subscriptions, publication)
+
+    def _unheard(self, topic):
+        # a publish without subscribers (still counted by metrics)
+        if self.metrics is not None:
+            self.metrics.published(topic, 0)
+
+    def _deliver(self, topic, event, subscriptions, publication,
+                 recipients=None):
+        """
+        delivers `publication` to `subscriptions`; `recipients` (default:
+        len(subscriptions)) is the number of subscriptions it goes to in
+        all, for metrics, which also count those served by a batch
+
+        returns the time the deliveries are timed from, or None if they
+        are not timed (see PubSubMetrics.published)
         """
-        exclude = iterablate(exclude)
-        eligible = iterablate(eligible)
-        subscriptions = self._subscriptions[topic].keys()
-        subscriptions = [subscription for subscription in subscriptions
-                         if subscription.key not in exclude]
-        if len(eligible) > 0:
-            subscriptions = [subscription for subscription in subscriptions
-                             if subscription.key in eligible]
+        metrics = self.metrics
+        start = None
+        if metrics is not None:
+            start = metrics.published(
+                topic, len(subscriptions) if recipients is None
+                else recipients)
+        dispatcher = self.dispatcher
+        if dispatcher is not None:
+            latest = None
+            if topic in self._conflated:
+                event_key = self._conflated[topic]
+                latest = (topic if event_key is None else
+                          (topic, event_key(event)))
+            for subscription in subscriptions:
+                if metrics is None:
+                    deliver = partial(subscription.deliver, publication)
+                else:
+                    deliver = partial(metrics.deliver, topic, start,
+                                      subscription, publication)
+                dispatcher.dispatch(subscription.key, deliver,
+                                    None if latest is None
+                                    else (subscription, latest))
+            return start
         for subscription in subscriptions:
             try:
-                subscription.callback(topic, event)
+                if metrics is None:
+                    subscription.deliver(publication)
+                else:
+                    metrics.deliver(topic, start, subscription, publication)
             except Exception as e:
                 import traceback
                 traceback.print_exc(e)
+        return start
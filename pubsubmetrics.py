@@ -0,0 +1,266 @@
+"""
+Per-topic and per-subscriber PubSub statistics
+
+    service = PubSub('WAMPSessions')
+    service.metrics = PubSubMetrics()
+    ...
+    service.metrics.as_dict()
+    service.metrics.prometheus()
+
+For each topic: the number of publishes, a histogram of the number of
+recipients per publish, delivery latency percentiles and callback
+errors.  For each subscriber key (e.g., WAMP session): callback errors
+and delivery latency.  Latency is measured from publish to the end of
+the subscriber's callback (so it includes time spent queued in a
+dispatcher) for one publish in every `sample_every`; percentiles are
+over each topic's most recent `samples` measurements, while the count and
+sum of the measurements are kept in full.
+
+Topics and keys are kept in LRU caches of `max_topics` and `max_keys`
+entries, so the memory used is bounded however many topics there are.
+Counters are updated without locking, so under heavy concurrency a few
+updates may be lost.
+"""
+from bisect import bisect_left
+from collections import deque
+from timeit import default_timer
+from wamputil import LRUCache
+
+
+class _TopicMetrics(object):
+
+    __slots__ = ('publishes', 'recipients', 'recipient_counts', 'errors',
+                 'timed', 'latency', 'latencies')
+
+    def __init__(self, buckets, samples):
+        self.publishes = 0
+        self.recipients = 0
+        self.recipient_counts = [0] * (buckets + 1)
+        self.errors = 0
+        # every sampled latency, for the summary's count and sum
+        self.timed = 0
+        self.latency = 0.0
+        # the most recent ones, for the quantiles
+        self.latencies = deque(maxlen=samples)
+
+
+class _KeyMetrics(object):
+
+    __slots__ = ('errors', 'timed', 'latency', 'max_latency')
+
+    def __init__(self):
+        self.errors = 0
+        self.timed = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+
+def _no_key(key):
+    return _KeyMetrics()
+
+
+def _percentile(ordered, quantile):
+    """ nearest-rank percentile of the sorted list `ordered` """
+    if not ordered:
+        return None
+    rank = int(quantile * len(ordered) + 0.5)
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def _label(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class PubSubMetrics(object):
+
+    recipient_buckets = (0, 1, 10, 100, 1000, 10000)
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, sample_every=100, samples=1024, max_topics=10000,
+                 max_keys=10000):
+        self.sample_every = sample_every
+        self.samples = samples
+        self._topics = LRUCache(max_topics)
+        self._keys = LRUCache(max_keys)
+        self._publishes = 0
+
+    def _new_topic(self, topic):
+        return _TopicMetrics(len(self.recipient_buckets), self.samples)
+
+    def _topic(self, topic):
+        return self._topics.lookup(topic, self._new_topic)
+
+    def _key(self, key):
+        return self._keys.lookup(key, _no_key)
+
+    # called by PubSub
+    def published(self, topic, recipients):
+        """
+        records a publish to `recipients` subscriptions; returns the time
+        it started if its deliveries are to be timed, else None
+        """
+        metrics = self._topic(topic)
+        metrics.publishes += 1
+        metrics.recipients += recipients
+        metrics.recipient_counts[bisect_left(self.recipient_buckets,
+                                             recipients)] += 1
+        self._publishes += 1
+        if self._publishes % self.sample_every == 0:
+            return default_timer()
+        return None
+
+    def deliver(self, topic, start, subscription, publication):
+        """
+        delivers `publication` to `subscription`, counting an error if
+        it raises and, if `start` is not None, timing it
+        """
+        try:
+            subscription.deliver(publication)
+        except Exception:
+            self.error(topic, subscription.key)
+            raise
+        finally:
+            if start is not None:
+                self.delivered(topic, subscription.key,
+                               default_timer() - start)
+
+    def deliver_batch(self, key, callback, entries):
+        """
+        calls callback(publications) for the (publication, start) pairs in
+        `entries`, counting an error (for `key` and each topic) if it
+        raises, and timing the publications whose `start` is not None
+        """
+        try:
+            callback([publication for publication, start in entries])
+        except Exception:
+            self._key(key).errors += 1
+            for topic in set(publication.topic
+                             for publication, start in entries):
+                self._topic(topic).errors += 1
+            raise
+        finally:
+            end = default_timer()
+            for publication, start in entries:
+                if start is not None:
+                    self.delivered(publication.topic, key, end - start)
+
+    def delivered(self, topic, key, latency):
+        metrics = self._topic(topic)
+        metrics.timed += 1
+        metrics.latency += latency
+        metrics.latencies.append(latency)
+        metrics = self._key(key)
+        metrics.timed += 1
+        metrics.latency += latency
+        if latency > metrics.max_latency:
+            metrics.max_latency = latency
+
+    def error(self, topic, key):
+        if topic is not None:
+            self._topic(topic).errors += 1
+        self._key(key).errors += 1
+
+    # exports
+    def _histogram(self, metrics):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.recipient_buckets + ('+Inf',),
+                                metrics.recipient_counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets
+
+    def as_dict(self):
+        """
+        returns {'topics': {topic: {...}}, 'keys': {key: {...}}}; see the
+        module docstring for the statistics
+        """
+        topics = dict()
+        for topic in self._topics.keys():
+            metrics = self._topics.get(topic)
+            if metrics is None:
+                continue
+            ordered = sorted(metrics.latencies)
+            topics[topic] = {
+                'publishes': metrics.publishes,
+                'recipients': {'sum': metrics.recipients,
+                               'buckets': self._histogram(metrics)},
+                'latency': dict([('count', metrics.timed),
+                                 ('sum', metrics.latency),
+                                 ('samples', len(ordered))] +
+                                [(quantile, _percentile(ordered, quantile))
+                                 for quantile in self.quantiles]),
+                'errors': metrics.errors}
+        keys = dict()
+        for key in self._keys.keys():
+            metrics = self._keys.get(key)
+            if metrics is None:
+                continue
+            keys[key] = {
+                'errors': metrics.errors,
+                'latency': {'samples': metrics.timed,
+                            'mean': (metrics.latency / metrics.timed
+                                     if metrics.timed else None),
+                            'max': metrics.max_latency}}
+        return {'topics': topics, 'keys': keys}
+
+    def prometheus(self, prefix='wamp_pubsub'):
+        """ returns the statistics in the Prometheus text format """
+        report = self.as_dict()
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, labels, value):
+            labels = ','.join('%s="%s"' % (label, _label(value))
+                              for label, value in labels)
+            if value is None:
+                value = 'NaN'
+            elif isinstance(value, (int, long)):
+                value = '%d' % value
+            else:
+                value = repr(value)
+            lines.append('%s_%s{%s} %s' % (prefix, name, labels, value))
+
+        topics = sorted(report['topics'].items())
+        keys = sorted(report['keys'].items())
+        metric('publishes_total', 'counter', "Events published")
+        for topic, metrics in topics:
+            sample('publishes_total', [('topic', topic)],
+                   metrics['publishes'])
+        metric('recipients', 'histogram', "Subscriptions per publish")
+        for topic, metrics in topics:
+            for bound, count in metrics['recipients']['buckets']:
+                sample('recipients_bucket',
+                       [('topic', topic), ('le', bound)], count)
+            sample('recipients_sum', [('topic', topic)],
+                   metrics['recipients']['sum'])
+            sample('recipients_count', [('topic', topic)],
+                   metrics['publishes'])
+        metric('delivery_seconds', 'summary',
+               "Sampled time from publish to the end of delivery")
+        for topic, metrics in topics:
+            for quantile in self.quantiles:
+                sample('delivery_seconds',
+                       [('topic', topic), ('quantile', quantile)],
+                       metrics['latency'][quantile])
+            sample('delivery_seconds_sum', [('topic', topic)],
+                   metrics['latency']['sum'])
+            sample('delivery_seconds_count', [('topic', topic)],
+                   metrics['latency']['count'])
+        metric('errors_total', 'counter', "Subscriber callback errors")
+        for topic, metrics in topics:
+            sample('errors_total', [('topic', topic)], metrics['errors'])
+        metric('key_errors_total', 'counter',
+               "Subscriber callback errors, by subscriber key")
+        for key, metrics in keys:
+            sample('key_errors_total', [('key', key)], metrics['errors'])
+        metric('key_delivery_seconds_max', 'gauge',
+               "Longest sampled delivery, by subscriber key")
+        for key, metrics in keys:
+            sample('key_delivery_seconds_max', [('key', key)],
+                   metrics['latency']['max'])
+        return '\n'.join(lines) + '\n'
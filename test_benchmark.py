@@ -0,0 +1,31 @@
+import unittest
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        report = benchmark.run(10, fanouts=(1, 10))
+        names = [result['name'] for result in report['results']]
+        self.assertIn('loads.EVENT', names)
+        self.assertIn('str.CALL', names)
+        self.assertIn('handle_wamp_message.PUBLISH', names)
+        self.assertIn('publish.10', names)
+        for result in report['results']:
+            self.assertTrue(result['ops_per_sec'] > 0)
+            retains = result['name'].split('.')[0] in ('loads', 'loads_lazy',
+                                                       'str')
+            self.assertEqual('retained_objects_per_op' in result, retains)
+
+    def test_compare(self):
+        baseline = {'results': [{'name': 'a', 'ops_per_sec': 100.0},
+                                {'name': 'b', 'ops_per_sec': 100.0}]}
+        report = {'results': [{'name': 'a', 'ops_per_sec': 90.0},
+                              {'name': 'b', 'ops_per_sec': 50.0},
+                              {'name': 'c', 'ops_per_sec': 1.0}]}
+        self.assertEqual(benchmark.compare(report, baseline, 0.2),
+                         [('b', 100.0, 50.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+import unittest
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from broker import PubSubBroker, BrokerBackend
+from pubsub import PubSub, TopicMatch
+
+
+class Subscriber(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.received = []
+
+    def callback(self, topic, event):
+        self.received.append((topic, event))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'broker.sock')
+        self.broker = PubSubBroker(self.path).start()
+        # two services with different names stand in for two processes
+        self.services = [PubSub('%s.%d' % (self.id(), i)) for i in range(2)]
+        self.backends = [BrokerBackend(self.path, channel=self.id())
+                         .attach(service) for service in self.services]
+
+    def tearDown(self):
+        for service, backend in zip(self.services, self.backends):
+            backend.close(5)
+            service.unsubscribe()
+        self.broker.close()
+        shutil.rmtree(self.directory)
+
+    def sync(self):
+        # a round trip through the broker from each backend
+        for backend in self.backends:
+            self.assertTrue(backend.flush(5))
+        time.sleep(0.05)
+
+    def test_publish(self):
+        local = Subscriber('local')
+        remote = Subscriber('remote')
+        excluded = Subscriber('excluded')
+        self.services[0].subscribe(local, local.key, 'topic', local.callback)
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.services[1].subscribe(excluded, excluded.key, 'topic',
+                                   excluded.callback)
+        self.sync()
+        for i in range(100):
+            self.services[0].publish('topic', {'i': i}, exclude='excluded')
+        self.assertTrue(wait_for(lambda: len(remote.received) == 100))
+        self.assertEqual(remote.received,
+                         [('topic', {'i': i}) for i in range(100)])
+        self.assertEqual(local.received, remote.received)
+        self.assertEqual(excluded.received, [])
+
+    def test_patterns(self):
+        remote = Subscriber('remote')
+        self.services[1].subscribe(remote, remote.key, 'stocks/*',
+                                   remote.callback, match=TopicMatch.PREFIX)
+        self.sync()
+        self.services[0].publish('stocks/ABC', 1)
+        self.services[0].publish('bonds/ABC', 2)
+        self.services[0].publish('stocks/XYZ', 3)
+        self.assertTrue(wait_for(lambda: len(remote.received) == 2))
+        self.assertEqual(remote.received, [('stocks/ABC', 1),
+                                           ('stocks/XYZ', 3)])
+
+    def test_unsubscribe(self):
+        remote = Subscriber('remote')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.sync()
+        self.services[0].publish('topic', 1)
+        self.assertTrue(wait_for(lambda: len(remote.received) == 1))
+        self.services[1].unsubscribe(remote)
+        self.sync()
+        self.assertEqual(self.broker._channels[self.id()].exact, {})
+        self.backends[1].close(5)
+        self.sync()
+        self.assertEqual(self.services[1].backend, None)
+        self.services[0].publish('topic', 2)
+        self.assertEqual(remote.received, [('topic', 1)])
+
+    def test_concurrent_subscriptions(self):
+        # events from the broker are delivered on the receiving thread
+        # while this thread changes the same topic's subscriptions
+        stable = Subscriber('stable')
+        self.services[1].subscribe(stable, stable.key, 'topic',
+                                   stable.callback)
+        self.sync()
+        count = 2000
+
+        def publish():
+            for i in range(count):
+                self.services[0].publish('topic', i,
+                                         eligible=['stable', 'churn'])
+
+        publisher = threading.Thread(target=publish)
+        churners = [Subscriber('churn') for i in range(10)]
+        patterns = ['topic'[:i] + '*' for i in range(1, 6)]
+        # switch threads as often as possible
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            publisher.start()
+            while publisher.is_alive():
+                for churner in churners:
+                    self.services[1].subscribe(churner, churner.key,
+                                               'topic', churner.callback)
+                    for pattern in patterns:
+                        self.services[1].subscribe(churner, churner.key,
+                                                   pattern,
+                                                   churner.callback,
+                                                   match=TopicMatch.PREFIX)
+                self.services[1].unsubscribe(key='churn')
+            publisher.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertTrue(wait_for(lambda: len(stable.received) == count))
+        self.assertEqual(stable.received,
+                         [('topic', i) for i in range(count)])
+
+    def test_call_soon(self):
+        scheduled = []
+
+        def call_soon(fn, arg):
+            scheduled.append((fn, arg))
+
+        self.backends[1].close(5)
+        self.backends[1] = BrokerBackend(self.path, channel=self.id(),
+                                         call_soon=call_soon)
+        self.backends[1].attach(self.services[1])
+        remote = Subscriber('remote')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.sync()
+        self.services[0].publish_many([('topic', 1), ('topic', 2)])
+        self.assertTrue(wait_for(lambda: scheduled))
+        self.assertEqual(remote.received, [])
+        for fn, arg in scheduled:
+            fn(arg)
+        self.assertEqual(remote.received, [('topic', 1), ('topic', 2)])
+
+    def test_collected_callback(self):
+        # the callback's object is collected on a thread that holds the
+        # backend's lock; reaping the subscription must not wait for it
+        remote = Subscriber('remote')
+        listener = Subscriber('listener')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   listener.callback)
+        self.sync()
+        self.assertIn('topic', self.broker._channels[self.id()].exact)
+        with self.backends[1]._lock:
+            del listener
+            gc.collect()
+        self.assertEqual(self.services[1]._subscriptions, {})
+        self.sync()
+        self.assertEqual(self.broker._channels[self.id()].exact, {})
+
+    def test_collected_subscriber(self):
+        remote = Subscriber('remote')
+        other = Subscriber('other')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.services[1].subscribe(other, other.key, 'other',
+                                   other.callback)
+        self.sync()
+        with self.backends[1]._lock:
+            del remote
+            gc.collect()
+        self.assertEqual(self.services[1]._subscriptions.keys(), ['other'])
+        # collected while the service is locked: cleaned up on unlock
+        self.services[1]._lock.acquire()
+        try:
+            del other
+            gc.collect()
+            self.assertEqual(self.services[1]._subscriptions.keys(),
+                             ['other'])
+        finally:
+            self.services[1]._unlock()
+        self.assertEqual(self.services[1]._subscriptions, {})
+        self.sync()
+        self.assertEqual(self.broker._channels[self.id()].exact, {})
+
+    def test_unencodable(self):
+        remote = Subscriber('remote')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.sync()
+        circular = {}
+        circular['self'] = circular
+        self.services[0].publish_many([('topic', 1), ('topic', circular),
+                                       ('topic', 2)])
+        self.assertTrue(wait_for(lambda: len(remote.received) == 2))
+        # only the event that could not be encoded is dropped
+        self.assertEqual(remote.received, [('topic', 1), ('topic', 2)])
+        self.assertIs(self.services[0].backend, self.backends[0])
+        self.services[0].publish('topic', 3)
+        self.assertTrue(wait_for(lambda: len(remote.received) == 3))
+
+    def test_broker_lost(self):
+        remote = Subscriber('remote')
+        self.services[1].subscribe(remote, remote.key, 'topic',
+                                   remote.callback)
+        self.sync()
+        self.broker.close()
+        for service, backend in zip(self.services, self.backends):
+            self.assertTrue(wait_for(lambda: service.backend is None))
+            for thread in backend._threads:
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        for i in range(1000):
+            self.services[0].publish('topic', i)
+            self.backends[0].publish('topic', i, [], [])
+        for backend in self.backends:
+            self.assertEqual(len(backend._outbox), 0)
+        # each service still works on its own
+        self.services[1].publish('topic', 'local')
+        self.assertEqual(remote.received, [('topic', 'local')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+import unittest
+import threading
+import time
+from dispatch import ThreadPoolDispatcher, LoopDispatcher, OverflowPolicy
+from pubsub import PubSub
+from wampsession import WAMPSession
+from wampmessage import WAMPMessage
+
+
+class Subscriber(object):
+
+    def __init__(self, key, delay=0):
+        self.key = key
+        self.delay = delay
+        self.received = []
+        self.threads = set()
+
+    def callback(self, topic, event):
+        self.threads.add(threading.current_thread())
+        time.sleep(self.delay)
+        self.received.append(event)
+
+
+class TestThreadPoolDispatcher(unittest.TestCase):
+
+    def test_ordering(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=4)
+        log = dict((key, []) for key in range(4))
+        for i in range(100):
+            for key in log:
+                dispatcher.dispatch(key, lambda key=key, i=i:
+                                    log[key].append(i))
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(dispatcher.pending, 0)
+        for key in log:
+            self.assertEqual(log[key], range(100))
+
+    def test_errors(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1)
+        log = []
+        dispatcher._run = lambda deliver: log.append(deliver())
+        dispatcher.dispatch('key', lambda: 1)
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [1])
+
+    def test_pubsub(self):
+        service = PubSub('test_thread_pool_dispatch')
+        service.dispatcher = ThreadPoolDispatcher(max_workers=2)
+        slow = Subscriber('slow', delay=0.1)
+        fast = Subscriber('fast')
+        service.subscribe(slow, slow.key, 'topic', slow.callback)
+        service.subscribe(fast, fast.key, 'topic', fast.callback)
+        start = time.time()
+        for i in range(5):
+            service.publish('topic', i)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertTrue(service.dispatcher.flush(5))
+        self.assertEqual(slow.received, range(5))
+        self.assertEqual(fast.received, range(5))
+        self.assertNotIn(threading.current_thread(), slow.threads)
+        service.unsubscribe()
+        service.dispatcher = None
+
+
+class TestOverflowPolicies(unittest.TestCase):
+
+    def fill(self, dispatcher, count):
+        """
+        holds the worker in a first delivery, then dispatches `count`
+        more; returns (the log of delivered values, the gate to release)
+        """
+        started = threading.Event()
+        gate = threading.Event()
+        log = []
+
+        def first():
+            started.set()
+            gate.wait(5)
+
+        dispatcher.dispatch('key', first)
+        started.wait(5)
+        for i in range(count):
+            dispatcher.dispatch('key', lambda i=i: log.append(i))
+        return log, gate
+
+    def test_drop_oldest(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1, max_queue=3)
+        log, gate = self.fill(dispatcher, 10)
+        self.assertEqual(dispatcher.stats('key'),
+                         {'depth': 3, 'max_depth': 3, 'dropped': 7,
+                          'conflated': 0, 'disconnected': False})
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [7, 8, 9])
+        self.assertEqual(dispatcher.stats('key')['depth'], 0)
+
+    def test_drop_newest(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1, max_queue=3,
+                                          overflow='DROP_NEWEST')
+        log, gate = self.fill(dispatcher, 10)
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [0, 1, 2])
+        self.assertEqual(dispatcher.stats('key')['dropped'], 7)
+
+    def test_disconnect(self):
+        disconnected = []
+        dispatcher = ThreadPoolDispatcher(max_workers=1, max_queue=3,
+                                          overflow=OverflowPolicy.DISCONNECT,
+                                          on_disconnect=disconnected.append)
+        log, gate = self.fill(dispatcher, 5)
+        self.assertEqual(disconnected, ['key'])
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [])
+        self.assertEqual(dispatcher.stats('key'),
+                         {'depth': 0, 'max_depth': 3, 'dropped': 5,
+                          'conflated': 0, 'disconnected': True})
+        dispatcher.forget('key')
+        dispatcher.dispatch('key', lambda: log.append('reconnected'))
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, ['reconnected'])
+
+    def test_block(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=2)
+        dispatcher.configure('key', max_queue=2, overflow='BLOCK')
+        log, gate = self.fill(dispatcher, 2)
+        publisher = threading.Thread(
+            target=dispatcher.dispatch, args=('key', lambda: log.append(2)))
+        publisher.start()
+        publisher.join(0.1)
+        self.assertTrue(publisher.is_alive())
+        gate.set()
+        publisher.join(5)
+        self.assertFalse(publisher.is_alive())
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [0, 1, 2])
+        self.assertEqual(dispatcher.stats('key')['dropped'], 0)
+
+    def test_configure(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1)
+        self.assertRaises(ValueError, dispatcher.configure, 'key', 0)
+        self.assertRaises(AttributeError, dispatcher.configure, 'key', 1,
+                          'DROP_EVERYTHING')
+
+    def test_session_stats(self):
+        service = PubSub('test_session_queue_stats')
+        session = WAMPSession(pubsub=service)
+        self.assertEqual(session.queue_stats, None)
+        service.dispatcher = ThreadPoolDispatcher(max_workers=1,
+                                                  max_queue=10)
+        session.send_wamp_message = lambda message: None
+        session.handle_wamp_message(WAMPMessage.SUBSCRIBE('topic'))
+        service.publish('topic', 'event')
+        self.assertTrue(service.dispatcher.flush(5))
+        self.assertEqual(session.queue_stats['max_depth'], 1)
+        service.unsubscribe(key=session.session_id)
+        self.assertNotIn(session.session_id, service.dispatcher._state)
+        service.dispatcher = None
+
+
+class TestConflation(unittest.TestCase):
+
+    def test_latest(self):
+        dispatcher = ThreadPoolDispatcher(max_workers=1)
+        started = threading.Event()
+        gate = threading.Event()
+        log = []
+        dispatcher.dispatch('key', lambda: (started.set(), gate.wait(5)))
+        started.wait(5)
+        for i in range(100):
+            dispatcher.dispatch('key', lambda i=i: log.append(('a', i)), 'a')
+            dispatcher.dispatch('key', lambda i=i: log.append(('b', i)), 'b')
+        dispatcher.dispatch('key', lambda: log.append('plain'))
+        self.assertEqual(dispatcher.stats('key')['depth'], 3)
+        self.assertEqual(dispatcher.stats('key')['conflated'], 198)
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(log, [('a', 99), ('b', 99), 'plain'])
+        self.assertEqual(dispatcher._latest, {})
+
+    def test_pubsub(self):
+        service = PubSub('test_conflation')
+        service.dispatcher = ThreadPoolDispatcher(max_workers=2)
+        service.conflate('prices', key=lambda event: event['symbol'])
+        service.conflate('presence')
+        slow = Subscriber('slow', delay=0.2)
+        fast = Subscriber('fast')
+        for sub in (slow, fast):
+            service.subscribe(sub, sub.key, 'prices', sub.callback)
+            service.subscribe(sub, sub.key, 'presence', sub.callback)
+        service.publish('presence', 'first')
+        time.sleep(0.05)
+        for i in range(50):
+            service.publish('prices', {'symbol': 'ABC', 'price': i})
+            service.publish('prices', {'symbol': 'XYZ', 'price': i})
+            service.publish('presence', i)
+        self.assertTrue(service.dispatcher.flush(5))
+        self.assertEqual(slow.received, ['first',
+                                         {'symbol': 'ABC', 'price': 49},
+                                         {'symbol': 'XYZ', 'price': 49}, 49])
+        for event in slow.received[1:]:
+            self.assertIn(event, fast.received)
+        service.unconflate('prices')
+        service.unconflate('presence')
+        service.unsubscribe()
+        service.dispatcher = None
+
+    def test_batch(self):
+        service = PubSub('test_conflation_batch')
+        service.dispatcher = ThreadPoolDispatcher(max_workers=1)
+        service.conflate('prices')
+        batches = []
+
+        def batch(publications):
+            batches.append([p.event for p in publications])
+
+        sub = Subscriber('sub')
+        service.subscribe(sub, sub.key, 'prices', sub.callback, batch=batch)
+        service.subscribe(sub, sub.key, 'news', sub.callback, batch=batch)
+        started = threading.Event()
+        gate = threading.Event()
+        service.dispatcher.dispatch(sub.key, lambda: (started.set(),
+                                                      gate.wait(5)))
+        started.wait(5)
+        for i in range(3):
+            service.publish_many([('prices', i), ('news', 'news%d' % i),
+                                  ('prices', i + 10)])
+        gate.set()
+        self.assertTrue(service.dispatcher.flush(5))
+        self.assertEqual(sub.received, [12])
+        self.assertEqual(batches, [['news0'], ['news1'], ['news2']])
+        service.unconflate('prices')
+        service.unsubscribe()
+        service.dispatcher = None
+
+
+class Loop(object):
+
+    """ a minimal event loop, run by hand """
+
+    def __init__(self):
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def call_soon(self, fn, arg):
+        with self.lock:
+            self.callbacks.append((fn, arg))
+
+    def run_once(self):
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for fn, arg in callbacks:
+            fn(arg)
+        return len(callbacks)
+
+    def run(self):
+        while self.run_once():
+            pass
+
+
+class TestLoopDispatcher(unittest.TestCase):
+
+    def test_pubsub(self):
+        loop = Loop()
+        service = PubSub('test_loop_dispatch')
+        service.dispatcher = LoopDispatcher(loop.call_soon)
+        subscribers = [Subscriber('sub%d' % i) for i in range(3)]
+        for sub in subscribers:
+            service.subscribe(sub, sub.key, 'topic', sub.callback)
+        for i in range(5):
+            service.publish('topic', i)
+        for sub in subscribers:
+            self.assertEqual(sub.received, [])
+        flushed = []
+        service.dispatcher.flush(lambda: flushed.append(
+            [len(sub.received) for sub in subscribers]))
+        # one delivery per key per callback
+        loop.run_once()
+        self.assertEqual([sub.received for sub in subscribers], [[0]] * 3)
+        loop.run()
+        for sub in subscribers:
+            self.assertEqual(sub.received, range(5))
+        self.assertEqual(flushed, [[5, 5, 5]])
+        service.dispatcher.flush(lambda: flushed.append('idle'))
+        loop.run()
+        self.assertEqual(flushed[-1], 'idle')
+        service.unsubscribe()
+        service.dispatcher = None
+
+    def test_block(self):
+        loop = Loop()
+        self.assertRaises(ValueError, LoopDispatcher, loop.call_soon,
+                          overflow=OverflowPolicy.BLOCK)
+        dispatcher = LoopDispatcher(loop.call_soon, max_queue=2)
+        self.assertRaises(ValueError, dispatcher.configure, 'key', 1,
+                          OverflowPolicy.BLOCK)
+        log = []
+        for i in range(5):
+            dispatcher.dispatch('key', lambda i=i: log.append(i))
+        loop.run()
+        self.assertEqual(log, [3, 4])
+        self.assertEqual(dispatcher.stats('key')['dropped'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import gc
-from pubsub import PubSub
+import pubsub
+from pubsub import PubSub, TopicMatch, TopicPattern
 from weakref import WeakValueDictionary
 import weakref
 
@@ -240,6 +241,239 @@ class TestPubSub(unittest.TestCase):
         subscriptions = service.subscriptions()
         self.assertEqual(len(subscriptions), 0)
 
+    def test_dead_callback_subscriptions(self):
+        service = PubSub('test_dead_callback_subscriptions')
+        sub = Subscriber('sub')
+        listener = Subscriber('listener')
+        service.subscribe(sub, sub.key, 'topic', listener.cb1)
+        service.subscribe(sub, sub.key, 'topic', sub.cb1)
+        self.assertEqual(len(service.subscriptions()['topic']), 2)
+        del listener
+        gc.collect()
+        subscriptions = service.subscriptions()
+        self.assertEqual(subscriptions['topic'], [(sub, sub.key, sub.cb1)])
+        service.publish('topic', 'event')
+        self.assertEqual(log['callbacks'],
+                         [(sub, Subscriber.cb1, 'topic', 'event')])
+
+    def test_subscriber_index(self):
+        service = PubSub('test_subscriber_index')
+        subscribers = [Subscriber('sub%d' % i) for i in range(1, 4)]
+        for sub in subscribers:
+            service.subscribe(sub, sub.key, 'topic1', sub.cb1)
+            service.subscribe(sub, sub.key, 'topic2', sub.cb1)
+        sub1, sub2, sub3 = subscribers
+        service.subscribe(sub1, 'other', 'topic1', sub1.cb2)
+        subscriptions = service.subscriptions(key=sub1.key)
+        self.assertEqual(dict(subscriptions),
+                         {'topic1': [(sub1, sub1.key, sub1.cb1)],
+                          'topic2': [(sub1, sub1.key, sub1.cb1)]})
+        subscriptions = service.subscriptions(subscriber=sub1,
+                                              topic='topic1')
+        self.assertEqual(len(subscriptions['topic1']), 2)
+        service.unsubscribe(sub1)
+        self.assertEqual(service.subscriptions(subscriber=sub1), {})
+        self.assertEqual(service.subscriptions(key='other'), {})
+        self.assertNotIn(id(sub1), service._subscribers)
+        self.assertNotIn(sub1.key, service._keys)
+        self.assertEqual(len(service.subscriptions()['topic1']), 2)
+        service.unsubscribe(key=sub2.key, topic='topic1')
+        self.assertEqual(dict(service.subscriptions(key=sub2.key)),
+                         {'topic2': [(sub2, sub2.key, sub2.cb1)]})
+        sub3_id = id(sub3)
+        del sub, sub3
+        del subscribers
+        gc.collect()
+        self.assertNotIn(sub3_id, service._subscribers)
+        self.assertNotIn('sub3', service._keys)
+        self.assertEqual(dict(service.subscriptions()),
+                         {'topic2': [(sub2, sub2.key, sub2.cb1)]})
+        service.unsubscribe()
+        self.assertEqual(service._subscribers, {})
+        self.assertEqual(service._keys, {})
+
+    def test_empty_topics(self):
+        service = PubSub('test_empty_topics')
+        unsubscribed = []
+
+        class Backend(object):
+            def subscribe_topic(self, topic):
+                pass
+
+            def unsubscribe_topic(self, topic):
+                unsubscribed.append(topic)
+
+            def publish(self, topic, event, exclude, eligible):
+                pass
+
+        service.backend = Backend()
+        publications = []
+        Publication = pubsub.Publication
+
+        class CountingPublication(Publication):
+            def __init__(self, topic, event):
+                publications.append(topic)
+                Publication.__init__(self, topic, event)
+
+        pubsub.Publication = CountingPublication
+        try:
+            for i in range(100):
+                service.publish('user/%d' % i, 'event')
+            service.publish_many([('user/1', 'event')])
+        finally:
+            pubsub.Publication = Publication
+        self.assertEqual(publications, [])
+        service.subscriptions(topic='user/1')
+        self.assertEqual(service._subscriptions, {})
+        sub1 = Subscriber('sub1')
+        sub2 = Subscriber('sub2')
+        service.subscribe(sub1, sub1.key, 'topic', sub1.cb1)
+        service.subscribe(sub2, sub2.key, 'topic', sub2.cb1)
+        service.subscribe(sub1, sub1.key, 'user/*', sub1.cb1,
+                          match=TopicMatch.PREFIX)
+        del sub1
+        gc.collect()
+        self.assertEqual(service._subscriptions.keys(), ['topic'])
+        self.assertEqual(len(service._patterns), 0)
+        self.assertEqual(unsubscribed,
+                         [TopicPattern(TopicMatch.PREFIX, 'user/')])
+        del sub2
+        gc.collect()
+        self.assertEqual(service._subscriptions, {})
+        self.assertEqual(service._topic_keys, {})
+        self.assertEqual(unsubscribed[1:], ['topic'])
+        service.backend = None
+
+    def test_pattern_subscriptions(self):
+        service = PubSub('test_pattern_subscriptions')
+        sub = Subscriber('sub')
+        service.subscribe(sub, sub.key, 'http://example.com/stocks/*',
+                          sub.cb1, match=TopicMatch.PREFIX)
+        service.subscribe(sub, sub.key, 'http://example.com/*/price',
+                          sub.cb2, match=TopicMatch.WILDCARD)
+        prefix = TopicPattern(TopicMatch.PREFIX, 'http://example.com/stocks/')
+        subscriptions = service.subscriptions()
+        self.assertEqual(subscriptions[prefix], [(sub, sub.key, sub.cb1)])
+        topics = ['http://example.com/stocks/ABC',
+                  'http://example.com/stocks/price',
+                  'http://example.com/bonds/price',
+                  'http://example.com/bonds/ABC/price',
+                  'http://example.com/stocks']
+        for topic in topics:
+            service.publish(topic, 'event')
+        self.assertEqual(log['callbacks'], [
+            (sub, Subscriber.cb1, topics[0], 'event'),
+            (sub, Subscriber.cb1, topics[1], 'event'),
+            (sub, Subscriber.cb2, topics[1], 'event'),
+            (sub, Subscriber.cb2, topics[2], 'event')])
+        service.unsubscribe(sub, topic='http://example.com/stocks/',
+                            match='PREFIX')
+        self.assertNotIn(prefix, service.subscriptions())
+        clear_log()
+        service.publish(topics[1], 'event')
+        self.assertEqual(log['callbacks'],
+                         [(sub, Subscriber.cb2, topics[1], 'event')])
+        service.unsubscribe()
+        self.assertEqual(len(service._patterns), 0)
+        self.assertFalse(service._patterns._root)
+
+    def test_prefix_partial_segment(self):
+        service = PubSub('test_prefix_partial_segment')
+        sub = Subscriber('sub')
+        service.subscribe(sub, sub.key, 'a/bc', sub.cb1,
+                          match=TopicMatch.PREFIX)
+        service.subscribe(sub, sub.key, 'a/b', sub.cb2,
+                          match=TopicMatch.PREFIX)
+        for topic in ['a/b', 'a/bcd/e', 'a', 'a/c', 'a/*']:
+            service.publish(topic, 'event')
+        self.assertEqual(sorted(log['callbacks']), sorted([
+            (sub, Subscriber.cb2, 'a/b', 'event'),
+            (sub, Subscriber.cb1, 'a/bcd/e', 'event'),
+            (sub, Subscriber.cb2, 'a/bcd/e', 'event')]))
+
+    def test_publish_filter_index(self):
+        service = PubSub('test_publish_filter_index')
+        subscribers = [Subscriber('sub%d' % i) for i in range(1, 11)]
+        for sub in subscribers:
+            service.subscribe(sub, sub.key, 'topic', sub.cb1)
+        service.publish('topic', 'event', exclude='sub1',
+                        eligible=['sub1', 'sub2', 'sub3', 'unknown'])
+        self.assertEqual(sorted(log['callbacks']), sorted([
+            (subscribers[1], Subscriber.cb1, 'topic', 'event'),
+            (subscribers[2], Subscriber.cb1, 'topic', 'event')]))
+        clear_log()
+        service.publish('topic', 'event',
+                        exclude=set(s.key for s in subscribers[1:]))
+        self.assertEqual(log['callbacks'],
+                         [(subscribers[0], Subscriber.cb1, 'topic', 'event')])
+        clear_log()
+        service.unsubscribe(key='sub2')
+        del subscribers[2], sub
+        gc.collect()
+        self.assertEqual(sorted(service._topic_keys['topic']),
+                         sorted(s.key for s in subscribers
+                                if s.key != 'sub2'))
+        service.publish('topic', 'event', eligible=['sub2', 'sub3', 'sub4'])
+        self.assertEqual(log['callbacks'],
+                         [(subscribers[2], Subscriber.cb1, 'topic', 'event')])
+        service.unsubscribe()
+        self.assertEqual(service._topic_keys, {})
+
+    def test_retain(self):
+        service = PubSub('test_retain')
+        service.retain(max_topics=2)
+        sub = Subscriber('sub')
+        service.publish('topic1', 'event1')
+        service.publish('topic1', 'event2')
+        service.publish('topic2', 'event3', exclude=sub.key)
+        service.publish('topic3', 'event4')
+        self.assertEqual(service.retained('topic1'), None)
+        self.assertEqual(service.retained('topic3'), 'event4')
+        service.subscribe(sub, sub.key, 'topic1', sub.cb1)
+        service.subscribe(sub, sub.key, 'topic2', sub.cb1)
+        service.subscribe(sub, sub.key, 'topic3', sub.cb1)
+        self.assertEqual(log['callbacks'],
+                         [(sub, Subscriber.cb1, 'topic3', 'event4')])
+        clear_log()
+        service.publish('topic3', 'event5')
+        service.subscribe(sub, sub.key, 'topic', sub.cb2,
+                          match=TopicMatch.PREFIX)
+        self.assertEqual(log['callbacks'],
+                         [(sub, Subscriber.cb1, 'topic3', 'event5'),
+                          (sub, Subscriber.cb2, 'topic3', 'event5')])
+        service.retain(0)
+        self.assertEqual(service.retained('topic3'), None)
+        service.unsubscribe()
+
+    def test_publish_many(self):
+        batches = []
+
+        def batch(publications):
+            batches.append([(p.topic, p.event) for p in publications])
+
+        service = PubSub('test_publish_many')
+        sub1, sub2 = Subscriber('sub1'), Subscriber('sub2')
+        service.subscribe(sub1, sub1.key, 'topic1', sub1.cb1, batch=batch)
+        service.subscribe(sub1, sub1.key, 'topic2', sub1.cb1, batch=batch)
+        service.subscribe(sub2, sub2.key, 'topic1', sub2.cb1)
+        self.assertRaises(TypeError, service.subscribe, sub2, sub2.key,
+                          'topic1', sub2.cb1, batch=sub2.cb1)
+        service.publish_many([('topic1', 'event1'),
+                              ('topic2', 'event2', 'sub2'),
+                              ('topic1', 'event3', 'sub1'),
+                              ('topic1', 'event4', None, ['sub2'])])
+        self.assertEqual(batches, [[('topic1', 'event1'),
+                                    ('topic2', 'event2')]])
+        self.assertEqual(log['callbacks'], [
+            (sub2, Subscriber.cb1, 'topic1', 'event1'),
+            (sub2, Subscriber.cb1, 'topic1', 'event3'),
+            (sub2, Subscriber.cb1, 'topic1', 'event4')])
+        clear_log()
+        service.publish('topic1', 'event5')
+        self.assertIn((sub1, Subscriber.cb1, 'topic1', 'event5'),
+                      log['callbacks'])
+        self.assertEqual(len(batches), 1)
+
     def test_publish(self):
 
         def callback(topic, event):
@@ -263,6 +497,34 @@ class TestPubSub(unittest.TestCase):
                       log['callbacks'])
         self.assertIn((callback, 'topic2', 'event2'), log['callbacks'])
 
+    def test_publication(self):
+        publications = []
+
+        def callback(publication):
+            publications.append(publication)
+
+        def factory(topic, event):
+            factory_calls.append((topic, event))
+            return (topic, event)
+
+        factory_calls = []
+        service = PubSub('test_publication')
+        subscribers = [Subscriber('sub%d' % i) for i in range(1, 4)]
+        for sub in subscribers:
+            service.subscribe(sub, sub.key, 'topic', callback,
+                              publication=True)
+        service.subscribe(sub, 'plain', 'topic', sub.cb1)
+        self.assertRaises(TypeError, service.subscribe, sub, sub.key,
+                          'topic', sub.cb1, publication=True)
+        service.publish('topic', 'event')
+        self.assertEqual(len(publications), 3)
+        self.assertIn((sub, Subscriber.cb1, 'topic', 'event'),
+                      log['callbacks'])
+        for publication in publications:
+            self.assertIs(publication, publications[0])
+            self.assertEqual(publication.memo(factory), ('topic', 'event'))
+        self.assertEqual(factory_calls, [('topic', 'event')])
+
     def test_publish_filter(self):
         service = PubSub('test_publish_filter')
         subscribers = [Subscriber('sub%d' % i) for i in range(1, 5)]
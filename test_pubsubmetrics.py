@@ -0,0 +1,158 @@
+import unittest
+from dispatch import ThreadPoolDispatcher
+from pubsub import PubSub
+from pubsubmetrics import PubSubMetrics
+
+
+class Subscriber(object):
+
+    def __init__(self, key, fail=False):
+        self.key = key
+        self.fail = fail
+        self.received = []
+
+    def callback(self, topic, event):
+        if self.fail:
+            raise ValueError(event)
+        self.received.append(event)
+
+
+class TestPubSubMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.service = PubSub(self.id())
+        self.service.metrics = PubSubMetrics(sample_every=1)
+        self.subscribers = [Subscriber('sub%d' % i) for i in range(3)]
+        self.subscribers.append(Subscriber('broken', fail=True))
+        for sub in self.subscribers:
+            self.service.subscribe(sub, sub.key, 'topic', sub.callback)
+        self.service.subscribe(self.subscribers[0], 'sub0', 'other',
+                               self.subscribers[0].callback)
+
+    def tearDown(self):
+        self.service.unsubscribe()
+        self.service.dispatcher = None
+
+    def publish(self):
+        for i in range(10):
+            self.service.publish('topic', i)
+        self.service.publish('other', 'event')
+        self.service.publish('empty', 'event')
+
+    def check(self, report):
+        topic = report['topics']['topic']
+        self.assertEqual(topic['publishes'], 10)
+        self.assertEqual(topic['recipients']['sum'], 40)
+        self.assertEqual(topic['recipients']['buckets'],
+                         [(0, 0), (1, 0), (10, 10), (100, 10), (1000, 10),
+                          (10000, 10), ('+Inf', 10)])
+        self.assertEqual(topic['errors'], 10)
+        self.assertEqual(topic['latency']['samples'], 40)
+        self.assertTrue(0 <= topic['latency'][0.5] <= topic['latency'][0.99])
+        self.assertEqual(report['topics']['empty']['recipients']['buckets'][0],
+                         (0, 1))
+        self.assertEqual(report['topics']['empty']['latency'][0.5], None)
+        self.assertEqual(report['keys']['broken']['errors'], 10)
+        self.assertEqual(report['keys']['sub0']['errors'], 0)
+        self.assertEqual(report['keys']['sub0']['latency']['samples'], 11)
+        self.assertEqual(self.subscribers[0].received, range(10) + ['event'])
+
+    def test_synchronous(self):
+        self.publish()
+        self.check(self.service.metrics.as_dict())
+
+    def test_dispatcher(self):
+        self.service.dispatcher = ThreadPoolDispatcher(max_workers=2)
+        self.publish()
+        self.assertTrue(self.service.dispatcher.flush(5))
+        self.check(self.service.metrics.as_dict())
+
+    def test_sampling(self):
+        self.service.metrics = PubSubMetrics(sample_every=5, samples=1)
+        self.publish()
+        report = self.service.metrics.as_dict()
+        self.assertEqual(report['topics']['topic']['publishes'], 10)
+        self.assertEqual(report['topics']['topic']['latency']['samples'], 1)
+        self.assertEqual(report['topics']['topic']['latency']['count'], 8)
+        self.assertEqual(report['keys']['sub0']['latency']['samples'], 2)
+
+    def test_bounded(self):
+        self.service.metrics = PubSubMetrics(max_topics=2)
+        for topic in ('a', 'b', 'c'):
+            self.service.publish(topic, 'event')
+        self.assertEqual(sorted(self.service.metrics.as_dict()['topics']),
+                         ['b', 'c'])
+
+    def test_batch_errors(self):
+        def batch(publications):
+            raise ValueError(publications)
+        sub = Subscriber('batched')
+        self.service.subscribe(sub, sub.key, 'batched', sub.callback,
+                               batch=batch)
+        self.service.publish_many([('batched', 1), ('batched', 2)])
+        report = self.service.metrics.as_dict()
+        self.assertEqual(report['keys']['batched']['errors'], 1)
+        self.assertEqual(report['topics']['batched']['errors'], 1)
+
+    def check_batched(self, flush):
+        batches = []
+
+        def batch(publications):
+            batches.append(len(publications))
+
+        subscribers = [Subscriber('batch%d' % i) for i in range(3)]
+        for sub in subscribers:
+            self.service.subscribe(sub, sub.key, 'batched', sub.callback,
+                                   batch=batch)
+        self.service.publish_many([('batched', 1), ('batched', 2)])
+        flush()
+        self.assertEqual(batches, [2, 2, 2])
+        report = self.service.metrics.as_dict()
+        topic = report['topics']['batched']
+        self.assertEqual(topic['publishes'], 2)
+        self.assertEqual(topic['recipients']['sum'], 6)
+        self.assertEqual(topic['latency']['samples'], 6)
+        for sub in subscribers:
+            self.assertEqual(report['keys'][sub.key]['latency']['samples'],
+                             2)
+
+    def test_batched(self):
+        self.check_batched(lambda: None)
+
+    def test_batched_dispatcher(self):
+        self.service.dispatcher = ThreadPoolDispatcher(max_workers=2)
+        self.check_batched(
+            lambda: self.assertTrue(self.service.dispatcher.flush(5)))
+
+    def test_prometheus(self):
+        self.publish()
+        text = self.service.metrics.prometheus()
+        self.assertIn('# TYPE wamp_pubsub_publishes_total counter\n', text)
+        self.assertIn('wamp_pubsub_publishes_total{topic="topic"} 10\n', text)
+        self.assertIn(
+            'wamp_pubsub_recipients_bucket{topic="topic",le="1"} 0\n',
+            text)
+        self.assertIn(
+            'wamp_pubsub_recipients_bucket{topic="topic",le="+Inf"} 10\n',
+            text)
+        self.assertIn('wamp_pubsub_delivery_seconds{topic="empty",'
+                      'quantile="0.5"} NaN\n', text)
+        self.assertIn('wamp_pubsub_key_errors_total{key="broken"} 10\n', text)
+        metrics = PubSubMetrics(samples=4)
+        for i in range(103):
+            metrics.delivered('timed', 'key', 0.5)
+        text = metrics.prometheus()
+        self.assertIn(
+            'wamp_pubsub_delivery_seconds_count{topic="timed"} 103\n', text)
+        self.assertIn(
+            'wamp_pubsub_delivery_seconds_sum{topic="timed"} 51.5\n', text)
+        self.assertEqual(metrics.as_dict()['topics']['timed']['latency'][0.5],
+                         0.5)
+        metrics = PubSubMetrics()
+        metrics.published('a "quoted"\ntopic', 0)
+        self.assertIn('{topic="a \\"quoted\\"\\ntopic"} 1\n',
+                      metrics.prometheus('x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import json
+import pickle
 from wampmessage import WAMPMessageType, WAMPMessage
 import wampmessage as WM
 
@@ -41,6 +42,18 @@ class TestWAMPMessage(unittest.TestCase):
             welcome2 = (WM.WAMPMessageWelcome.
                         welcome("session1", "protocol5", "server10"))
 
+    def test_dispatch_table(self):
+        for message_type in WAMPMessageType.values:
+            message_cls = WAMPMessage.__dict__[message_type.str]
+            self.assertIs(getattr(WAMPMessage, message_type.str),
+                          message_cls)
+            self.assertEqual(message_cls._type, message_type)
+        for bad_type in (-1, 99, None, 'EVENT'):
+            with self.assertRaises(AssertionError):
+                WAMPMessage(bad_type, 'topic', 'event')
+        with self.assertRaises(AssertionError):
+            WAMPMessage.loads('[99, "topic"]')
+
     def test_equality(self):
         welcome_b1 = WAMPMessage(type=WAMPMessageType.WELCOME,
                                  session_id="session1")
@@ -63,6 +76,135 @@ class TestWAMPMessage(unittest.TestCase):
         self.assertEqual(call1, call2)
         self.assertNotEqual(call1, call3)
 
+    def test_memoized_dumps(self):
+        event = WAMPMessage.EVENT('topic', {'key': 'value'})
+        data = event.dumps()
+        self.assertEqual(data, '[8, "topic", {"key": "value"}]')
+        self.assertIs(event.dumps(), data)
+        self.assertIs(str(event), data)
+        event.event = 'new value'
+        self.assertEqual(event.dumps(), '[8, "topic", "new value"]')
+        self.assertEqual(str(event), '[8, "topic", "new value"]')
+
+    def test_slots(self):
+        call = WAMPMessage.CALL('call1', 'proc_uri', 'arg1')
+        self.assertFalse(hasattr(call, '__dict__'))
+        with self.assertRaises(AttributeError):
+            call.not_a_field = True
+        publish = WAMPMessage.PUBLISH('topic', 'event', True)
+        self.assertTrue(publish.exclude_me)
+        self.assertFalse(hasattr(publish, 'exclude'))
+
+    def test_event_prefix_cache(self):
+        cache = WM.WAMPMessageEvent.prefix_cache
+        cache.clear()
+        topic = 'http://example.com/stocks/ABC'
+        event1 = WAMPMessage.EVENT(topic, {'price': 1})
+        self.assertEqual(event1.dumps(), json.dumps(event1.json))
+        self.assertEqual(cache.stats()['misses'], 1)
+        event2 = WAMPMessage.EVENT(topic, ['price', 2])
+        self.assertEqual(event2.dumps(), json.dumps(event2.json))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['size'], 1)
+        lazy = WAMPMessage.loads('[8, "%s", "event"]' % topic, lazy=True)
+        lazy.topic_uri = topic
+        self.assertEqual(lazy.dumps(), '[8, "%s", "event"]' % topic)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_memoized_json(self):
+        call = WAMPMessage.CALL('call1', 'proc_uri', 'arg1')
+        self.assertIs(call.json, call.json)
+        call.proc_uri = 'new_uri'
+        self.assertEqual(call.json, [WAMPMessageType.CALL,
+                                     'call1', 'new_uri', 'arg1'])
+        self.assertEqual(str(call), '[2, "call1", "new_uri", "arg1"]')
+
+    def test_field_equality(self):
+        self.assertNotEqual(WAMPMessage.SUBSCRIBE('topic'),
+                            WAMPMessage.UNSUBSCRIBE('topic'))
+        self.assertEqual(hash(WAMPMessage.SUBSCRIBE('topic')),
+                         hash(WAMPMessage.SUBSCRIBE('topic')))
+        self.assertNotEqual(WAMPMessage.PUBLISH('topic', 'event', True),
+                            WAMPMessage.PUBLISH('topic', 'event'))
+        self.assertNotEqual(WAMPMessage.PUBLISH('topic', 'event', 'ex1'),
+                            WAMPMessage.PUBLISH('topic', 'event', None, 'ex1'))
+        self.assertEqual(WAMPMessage.PUBLISH('topic', 'event', 'ex1'),
+                         WAMPMessage.PUBLISH('topic', 'event', ['ex1']))
+        self.assertNotEqual(WAMPMessage.EVENT('topic', 'event'), 'event')
+
+    def test_pickle(self):
+        messages = [WAMPMessage.CALL('call1', 'proc_uri', 'arg1'),
+                    WAMPMessage.CALLERROR('call1', 'uri', 'desc'),
+                    WAMPMessage.PUBLISH('topic', 'event', True),
+                    WAMPMessage.EVENT('topic', {'key': 'value'})]
+        for message in messages:
+            str(message)
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(message, protocol))
+                self.assertEqual(copy, message)
+                self.assertEqual(copy.json, message.json)
+
+
+class TestWAMPMessageLazy(unittest.TestCase):
+
+    def test_event(self):
+        raw = '[8, "topic", {"key": ["value", "]"]}]'
+        event = WAMPMessage.loads(raw, lazy=True)
+        self.assertTrue(isinstance(event, WM.WAMPMessageEvent))
+        self.assertTrue(isinstance(event, WM.WAMPMessageLazyMixin))
+        self.assertEqual(event.topic_uri, 'topic')
+        self.assertEqual(event.raw_payload, '{"key": ["value", "]"]}')
+        self.assertIs(event.dumps(), raw)
+        self.assertEqual(event.event, {'key': ['value', ']']})
+        self.assertEqual(event.raw_payload, None)
+        self.assertIs(event.dumps(), raw)
+        self.assertEqual(event, WAMPMessage.loads(raw))
+        event.event = 'new'
+        self.assertEqual(str(event), '[8, "topic", "new"]')
+
+    def test_call(self):
+        raw = '[2, "call1", "prefix:proc", "arg1", {"arg2": 2}]'
+        call = WAMPMessage.loads(raw, lazy=True)
+        self.assertEqual(call.call_id, 'call1')
+        self.assertEqual(call.proc_uri, 'prefix:proc')
+        self.assertEqual(call.raw_payload, '"arg1", {"arg2": 2}')
+        call.proc_uri = 'http://example.com/proc'
+        self.assertEqual(call.raw_payload, '"arg1", {"arg2": 2}')
+        self.assertEqual(call.dumps(), '[2, "call1", "http://example.com/'
+                         'proc", "arg1", {"arg2": 2}]')
+        self.assertEqual(call.args, ['arg1', {'arg2': 2}])
+        call = WAMPMessage.loads('[2, "call1", "proc"]', lazy=True)
+        self.assertEqual(call.args, [])
+        call.call_id = 'call2'
+        self.assertEqual(call.dumps(), '[2, "call2", "proc"]')
+
+    def test_publish(self):
+        publish = WAMPMessage.loads('[7, "topic", "event", true]', lazy=True)
+        self.assertEqual(publish.topic_uri, 'topic')
+        self.assertTrue(publish.exclude_me)
+        self.assertFalse(hasattr(publish, 'exclude'))
+        publish = WAMPMessage.loads('[7, "topic", "event", ["ex1"]]',
+                                    lazy=True)
+        self.assertEqual(publish.exclude, ['ex1'])
+        self.assertEqual(publish.eligible, [])
+        self.assertEqual(publish,
+                         WAMPMessage.PUBLISH('topic', 'event', ['ex1']))
+
+    def test_eager_types(self):
+        welcome = WAMPMessage.loads('[0, "session1", 1, 1]', lazy=True)
+        self.assertFalse(isinstance(welcome, WM.WAMPMessageLazyMixin))
+        self.assertEqual(welcome, WAMPMessage.WELCOME('session1'))
+
+    def test_malformed(self):
+        for raw in ('[8]', '[8, "topic" "event"]', '[8, "topic"] x'):
+            with self.assertRaises(ValueError):
+                WAMPMessage.loads(raw, lazy=True)
+
+    def test_pickle(self):
+        event = WAMPMessage.loads('[8, "topic", "event"]', lazy=True)
+        copy = pickle.loads(pickle.dumps(event, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, event)
+
 
 class TestWAMPMessageSubclasses(unittest.TestCase):
 
@@ -0,0 +1,84 @@
+import unittest
+import wampserializer
+from wampserializer import (WAMPSerializer, JSONSerializer, get_serializer,
+                            set_default_serializer, register_serializer,
+                            available_serializers)
+from wampmessage import WAMPMessage, WAMPMessageType
+
+
+messages = [WAMPMessage.WELCOME('session1'),
+            WAMPMessage.PREFIX('prefix', 'uri'),
+            WAMPMessage.CALL('call1', 'proc_uri', 'arg1', {'arg2': [1, 2]}),
+            WAMPMessage.CALLRESULT('call1', {'key': 'value'}),
+            WAMPMessage.CALLERROR('call1', 'uri', 'desc', {'key': 'value'}),
+            WAMPMessage.SUBSCRIBE('topic'),
+            WAMPMessage.UNSUBSCRIBE('topic'),
+            WAMPMessage.PUBLISH('topic', 'event', ['ex1'], ['el1']),
+            WAMPMessage.EVENT('topic', {'key': 'value'})]
+
+
+class TestWAMPSerializer(unittest.TestCase):
+
+    def tearDown(self):
+        set_default_serializer('json')
+
+    def assertRoundTrips(self, serializer):
+        for message in messages:
+            data = message.dumps(serializer)
+            decoded = WAMPMessage.loads(data, serializer)
+            self.assertTrue(isinstance(decoded, message.__class__))
+            self.assertEqual(decoded, message)
+
+    def test_registry(self):
+        self.assertIn('json', available_serializers())
+        self.assertIn('fastjson', available_serializers())
+        json_serializer = get_serializer('json')
+        self.assertTrue(isinstance(json_serializer, JSONSerializer))
+        self.assertEqual(get_serializer(), json_serializer)
+        self.assertEqual(get_serializer(json_serializer), json_serializer)
+        self.assertRaises(ValueError, get_serializer, 'not_a_serializer')
+
+    def test_default(self):
+
+        class ReprSerializer(WAMPSerializer):
+
+            name = 'repr'
+
+            def dumps(self, obj):
+                return repr([int(obj[0])] + obj[1:])
+
+            def loads(self, data):
+                return eval(data)
+
+        register_serializer(ReprSerializer())
+        event = WAMPMessage.EVENT('topic', 'event')
+        self.assertEqual(str(event), '[8, "topic", "event"]')
+        set_default_serializer('repr')
+        self.assertEqual(str(event), "[8, 'topic', 'event']")
+        self.assertEqual(WAMPMessage.loads("[8, 'topic', 'event']"), event)
+        self.assertRoundTrips(None)
+
+    def test_json(self):
+        self.assertRoundTrips('json')
+        self.assertEqual(WAMPMessage.EVENT('topic', 'event').dumps('json'),
+                         '[8, "topic", "event"]')
+
+    def test_fastjson(self):
+        self.assertRoundTrips('fastjson')
+
+    @unittest.skipUnless(wampserializer.ujson, "ujson is not installed")
+    def test_ujson(self):
+        self.assertRoundTrips('ujson')
+
+    @unittest.skipUnless(wampserializer.msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        self.assertTrue(get_serializer('msgpack').binary)
+        self.assertRoundTrips('msgpack')
+        exclude_me = WAMPMessage.PUBLISH('topic', 'event', True)
+        decoded = WAMPMessage.loads(exclude_me.dumps('msgpack'), 'msgpack')
+        self.assertEqual(decoded.json, [WAMPMessageType.PUBLISH,
+                                        'topic', 'event', True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,12 @@ import unittest
 import gc
 import weakref
 import concurrent.futures
+import threading
 import time
 from wampsession import WAMPSession
 from wampmessage import WAMPMessage, WAMPMessageType
 from wampexc import WAMPError
+from wampserializer import get_serializer
 from pubsub import PubSub
 
 
@@ -16,6 +18,16 @@ class TestWAMPSession(unittest.TestCase):
         self.assertTrue(isinstance(session.session_id, basestring))
         self.assertEqual(id(session.pubsub), id(PubSub('WAMPSessions')))
 
+    def test_serializer(self):
+        session = WAMPSession()
+        self.assertEqual(session.serializer, get_serializer('json'))
+        event = WAMPMessage.EVENT('topic', 'event')
+        self.assertEqual(session.dumps(event), '[8, "topic", "event"]')
+        self.assertEqual(session.loads('[8, "topic", "event"]'), event)
+        session = WAMPSession(serializer='fastjson')
+        self.assertEqual(session.serializer, get_serializer('fastjson'))
+        self.assertEqual(session.loads(session.dumps(event)), event)
+
     def test_registered_procedures(self):
 
         class MyClass(object):
@@ -158,6 +170,65 @@ class TestWAMPSession(unittest.TestCase):
                          ('send1',
                           WAMPMessage.CALLRESULT('call3', ('proc', 'arg3'))))
 
+    def test_call_callback_cached(self):
+
+        class Transport(object):
+
+            def __init__(self):
+                self.sent = []
+
+            def send(self, message):
+                self.sent.append(message)
+
+            def bad_send(self):
+                pass
+
+        def proc(*args):
+            return args
+
+        session = WAMPSession()
+        session.register_procedure('proc', proc)
+        transport = Transport()
+        for i in range(3):
+            session.handle_wamp_message(WAMPMessage.CALL('call', 'proc', i),
+                                        transport.send)
+        callback = session._call_callback
+        self.assertEqual(callback.reverted(), transport.send)
+        session.handle_wamp_message(WAMPMessage.CALL('call', 'proc', 3),
+                                    transport.send)
+        self.assertTrue(session._call_callback is callback)
+        self.assertEqual(transport.sent,
+                         [WAMPMessage.CALLRESULT('call', (i,))
+                          for i in range(4)])
+        other = Transport()
+        session.handle_wamp_message(WAMPMessage.CALL('call', 'proc', 4),
+                                    other.send)
+        self.assertEqual(other.sent, [WAMPMessage.CALLRESULT('call', (4,))])
+        self.assertRaises(TypeError, session.handle_wamp_message,
+                          WAMPMessage.CALL('call', 'proc'), other.bad_send)
+        weak_transport = weakref.ref(other)
+        del other
+        gc.collect()
+        self.assertEqual(weak_transport(), None)
+
+    def test_handler_table(self):
+
+        class CustomSession(WAMPSession):
+
+            def _handle_EVENT(self, message):
+                self.events = getattr(self, 'events', []) + [message]
+
+        self.assertEqual(len(WAMPSession._handlers),
+                         len(WAMPMessageType._values))
+        self.assertEqual(WAMPSession._handlers[WAMPMessageType.CALL],
+                         WAMPSession._handle_CALL.__func__)
+        session = CustomSession()
+        message = WAMPMessage.EVENT('topic', 'event')
+        session.handle_wamp_message(message)
+        self.assertEqual(session.events, [message])
+        session.handle_wamp_message(WAMPMessage.PREFIX('prefix', 'uri'))
+        self.assertEqual(session.prefixes, {'prefix': 'uri'})
+
     def test_call_exceptions(self):
 
         def wamp_error(*args):
@@ -273,6 +344,69 @@ class TestWAMPSession(unittest.TestCase):
         self.assertEqual(message_log[0],
                          WAMPMessage.EVENT('topic_uri', ['third', 'event']))
 
+    def test_pubsub_shared_event(self):
+
+        message_log = []
+
+        def send_wamp_message(message):
+            message_log.append(message)
+
+        pubsub = PubSub('test_pubsub_shared_event')
+        sessions = [WAMPSession(pubsub=pubsub) for i in range(3)]
+        for session in sessions:
+            session.send_wamp_message = send_wamp_message
+            session.handle_wamp_message(WAMPMessage.SUBSCRIBE('topic_uri'))
+        sessions[0].handle_wamp_message(
+            WAMPMessage.PUBLISH('topic_uri', {'key': 'value'}))
+        self.assertEqual(len(message_log), 3)
+        for message in message_log:
+            self.assertIs(message, message_log[0])
+            self.assertIs(sessions[0].dumps(message),
+                          sessions[0].dumps(message_log[0]))
+        self.assertEqual(message_log[0],
+                         WAMPMessage.EVENT('topic_uri', {'key': 'value'}))
+
+    def test_pubsub_retained_event(self):
+
+        message_log = []
+
+        def send_wamp_message(message):
+            message_log.append(message)
+
+        pubsub = PubSub('test_pubsub_retained_event')
+        pubsub.retain()
+        publisher, subscriber = WAMPSession(pubsub), WAMPSession(pubsub)
+        publisher.handle_wamp_message(
+            WAMPMessage.PUBLISH('topic_uri', 'state', True))
+        subscriber.send_wamp_message = send_wamp_message
+        subscriber.handle_wamp_message(WAMPMessage.SUBSCRIBE('topic_uri'))
+        self.assertEqual(message_log,
+                         [WAMPMessage.EVENT('topic_uri', 'state')])
+
+    def test_pubsub_batch(self):
+
+        message_log = []
+        batch_log = []
+
+        def send_wamp_message(message):
+            message_log.append(message)
+
+        def send_wamp_messages(messages):
+            batch_log.append(messages)
+
+        pubsub = PubSub('test_pubsub_batch')
+        sessions = [WAMPSession(pubsub=pubsub) for i in range(2)]
+        for session in sessions:
+            session.send_wamp_message = send_wamp_message
+            session.handle_wamp_message(WAMPMessage.SUBSCRIBE('topic1'))
+            session.handle_wamp_message(WAMPMessage.SUBSCRIBE('topic2'))
+        sessions[0].send_wamp_messages = send_wamp_messages
+        pubsub.publish_many([('topic1', 'event1'), ('topic2', 'event2')])
+        events = [WAMPMessage.EVENT('topic1', 'event1'),
+                  WAMPMessage.EVENT('topic2', 'event2')]
+        self.assertEqual(batch_log, [events])
+        self.assertEqual(message_log, events)
+
     def test_event(self):
 
         event_log = []
@@ -391,5 +525,196 @@ class TestAsyncWAMPSession(unittest.TestCase):
                                           'async_b2', 'async_a3', 'async_b3'])
 
 
+class Deferred(object):
+
+    """ just enough of twisted.internet.defer.Deferred """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def addCallbacks(self, callback, errback):
+        self.callbacks.append((callback, errback))
+
+    def callback(self, result):
+        for callback, errback in self.callbacks:
+            result = callback(result)
+
+    def errback(self, failure):
+        for callback, errback in self.callbacks:
+            failure = errback(failure)
+
+
+class Failure(object):
+
+    def __init__(self, value):
+        self.value = value
+
+
+class TestAsyncProcedures(unittest.TestCase):
+
+    def setUp(self):
+        self.message_log = []
+        self.session = WAMPSession()
+        self.session.send_wamp_message = self.send_wamp_message
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def send_wamp_message(self, message):
+        self.message_log.append(message)
+
+    def test_future(self):
+        gate = concurrent.futures.Future()
+
+        def slow(*args):
+            return self.executor.submit(lambda: (gate.result(5), args)[1])
+
+        def failing(*args):
+            return self.executor.submit(self.fail_with, WAMPError(
+                'some_uri', 'expected error', {'key': 'value'}))
+
+        self.session.register_procedure('slow', slow)
+        self.session.register_procedure('failing', failing)
+        self.session.register_procedure('fast', lambda *args: 'fast')
+        self.session.handle_wamp_message(WAMPMessage.CALL('c1', 'slow', 1))
+        self.session.handle_wamp_message(WAMPMessage.CALL('c2', 'fast'))
+        self.assertEqual(self.message_log,
+                         [WAMPMessage.CALLRESULT('c2', 'fast')])
+        gate.set_result(True)
+        self.session.handle_wamp_message(WAMPMessage.CALL('c3', 'failing'))
+        self.executor.shutdown()
+        self.assertEqual(len(self.message_log), 3)
+        self.assertIn(WAMPMessage.CALLRESULT('c1', (1,)), self.message_log)
+        self.assertIn(WAMPMessage.CALLERROR('c3', 'some_uri',
+                                            'expected error',
+                                            {'key': 'value'}),
+                      self.message_log)
+
+    def fail_with(self, error):
+        raise error
+
+    def test_deferred(self):
+        deferreds = []
+
+        def deferred(*args):
+            deferreds.append(Deferred())
+            return deferreds[-1]
+
+        sent = []
+
+        def send(message):
+            sent.append(message)
+
+        self.session.register_procedure('deferred', deferred)
+        self.session.handle_wamp_message(WAMPMessage.CALL('c1', 'deferred'))
+        self.session.handle_wamp_message(WAMPMessage.CALL('c2', 'deferred'),
+                                         send)
+        self.assertEqual(self.message_log, [])
+        deferreds[1].errback(Failure(ValueError('bad value')))
+        deferreds[0].callback(None)
+        self.assertEqual(self.message_log,
+                         [WAMPMessage.CALLRESULT('c1', None)])
+        self.assertEqual(sent, [WAMPMessage.CALLERROR(
+            'c2', 'errors/unknown', 'unknown error', ('bad value',))])
+
+    def test_executor(self):
+        threads = set()
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def blocking(*args):
+            with lock:
+                running.append(args)
+                most.append(len(running))
+            threads.add(threading.current_thread())
+            time.sleep(0.05)
+            with lock:
+                running.remove(args)
+            if args == ('fail',):
+                raise ValueError('failed')
+            return args
+
+        self.assertRaises(ValueError, self.session.register_procedure,
+                          'blocking', blocking, max_concurrent=1)
+        self.assertRaises(ValueError, self.session.register_procedure,
+                          'blocking', blocking, self.executor, 0)
+        self.session.register_procedure('blocking', blocking, self.executor,
+                                        max_concurrent=1)
+        scheduled = []
+
+        def call_soon(fn, arg):
+            scheduled.append((fn, arg))
+
+        self.session.call_soon = call_soon
+        for i in range(3):
+            self.session.handle_wamp_message(
+                WAMPMessage.CALL('c%d' % i, 'blocking', i))
+        self.session.handle_wamp_message(
+            WAMPMessage.CALL('c3', 'blocking', 'fail'))
+        self.assertNotIn(threading.current_thread(), threads)
+        deadline = time.time() + 5
+        while len(scheduled) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(max(most), 1)
+        self.assertEqual(self.message_log, [])
+        for fn, arg in scheduled:
+            fn(arg)
+        self.assertEqual(self.message_log,
+                         [WAMPMessage.CALLRESULT('c%d' % i, (i,))
+                          for i in range(3)] +
+                         [WAMPMessage.CALLERROR('c3', 'errors/unknown',
+                                                'unknown error',
+                                                ('failed',))])
+        del self.session.call_soon
+        self.session.register_procedure('unlimited', blocking, self.executor)
+        self.session.handle_wamp_message(
+            WAMPMessage.CALL('c4', 'unlimited', 4))
+        self.executor.shutdown()
+        self.assertEqual(self.message_log[-1],
+                         WAMPMessage.CALLRESULT('c4', (4,)))
+
+    def test_max_concurrent_long_queue(self):
+        # calls refused by the executor, or finished as soon as they are
+        # submitted, must not recurse once per waiting call
+        class Executor(object):
+            def __init__(self):
+                self.first = concurrent.futures.Future()
+                self.mode = 'first'
+
+            def submit(self, fn, *args):
+                if self.mode == 'first':
+                    self.mode = None
+                    return self.first
+                if self.mode == 'refuse':
+                    raise RuntimeError('executor is shut down')
+                future = concurrent.futures.Future()
+                future.set_result(fn(*args))
+                return future
+
+        count = 3000
+        for mode in ('refuse', 'inline'):
+            executor = Executor()
+            del self.message_log[:]
+            self.session.register_procedure(mode, lambda *args: args,
+                                            executor, max_concurrent=1)
+            for i in range(count):
+                self.session.handle_wamp_message(
+                    WAMPMessage.CALL('c%d' % i, mode, i))
+            self.assertEqual(self.message_log, [])
+            executor.mode = mode
+            executor.first.set_result((0,))
+            self.assertEqual(len(self.message_log), count)
+            self.assertEqual(self.message_log[0],
+                             WAMPMessage.CALLRESULT('c0', (0,)))
+            if mode == 'inline':
+                self.assertEqual(self.message_log[-1],
+                                 WAMPMessage.CALLRESULT('c%d' % (count - 1),
+                                                        (count - 1,)))
+            else:
+                self.assertEqual(self.message_log[-1].type,
+                                 WAMPMessageType.CALLERROR)
+
 if __name__ == '__main__':
     unittest.main()
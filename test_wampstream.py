@@ -0,0 +1,99 @@
+import unittest
+import wampserializer
+from wampmessage import WAMPMessage
+from wampstream import WAMPFraming, WAMPStreamDecoder, frame_message
+
+
+class TestWAMPStreamDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [WAMPMessage.WELCOME('session1'),
+                         WAMPMessage.CALL('call1', 'proc_uri', 'arg1'),
+                         WAMPMessage.EVENT('topic', {'key': 'value'})]
+
+    def test_frame_message(self):
+        event = WAMPMessage.EVENT('topic', 'event')
+        self.assertEqual(frame_message(event), '[8, "topic", "event"]\n')
+        self.assertEqual(frame_message(event, WAMPFraming.LENGTH_PREFIXED),
+                         '\x00\x00\x00\x15[8, "topic", "event"]')
+
+    def test_newline(self):
+        decoder = WAMPStreamDecoder()
+        stream = ''.join(frame_message(m) for m in self.messages)
+        self.assertEqual(list(decoder.feed(stream)), self.messages)
+        self.assertEqual(decoder.buffered, 0)
+
+    def test_length_prefixed(self):
+        decoder = WAMPStreamDecoder(WAMPFraming.LENGTH_PREFIXED)
+        stream = ''.join(frame_message(m, WAMPFraming.LENGTH_PREFIXED)
+                         for m in self.messages)
+        self.assertEqual(list(decoder.feed(stream)), self.messages)
+        self.assertEqual(decoder.buffered, 0)
+
+    def test_partial_frames(self):
+        for framing in WAMPFraming.values:
+            decoder = WAMPStreamDecoder(framing)
+            stream = ''.join(frame_message(m, framing)
+                             for m in self.messages)
+            decoded = []
+            for i in range(len(stream)):
+                decoded.extend(decoder.feed(stream[i]))
+            self.assertEqual(decoded, self.messages)
+            self.assertEqual(decoder.buffered, 0)
+
+    def test_buffered(self):
+        decoder = WAMPStreamDecoder()
+        decoded = list(decoder.feed('[5, "topic"]\n[6, "to'))
+        self.assertEqual(decoded, [WAMPMessage.SUBSCRIBE('topic')])
+        self.assertEqual(decoder.buffered, len('[6, "to'))
+        decoded = list(decoder.feed('pic"]\n\n'))
+        self.assertEqual(decoded, [WAMPMessage.UNSUBSCRIBE('topic')])
+        self.assertEqual(decoder.buffered, 0)
+
+    def test_bad_frame(self):
+        decoder = WAMPStreamDecoder()
+        decoded = decoder.feed('[5, "topic"\n[6, "topic"]\n')
+        with self.assertRaises(ValueError):
+            next(decoded)
+        self.assertEqual(list(decoder), [WAMPMessage.UNSUBSCRIBE('topic')])
+
+    def test_max_frame_size(self):
+        decoder = WAMPStreamDecoder(max_frame_size=8)
+        with self.assertRaises(ValueError):
+            list(decoder.feed('[5, "long_topic"'))
+        decoder = WAMPStreamDecoder(WAMPFraming.LENGTH_PREFIXED,
+                                    max_frame_size=8)
+        with self.assertRaises(ValueError):
+            list(decoder.feed('\x00\x00\x01\x00'))
+        with self.assertRaises(ValueError):
+            list(decoder.feed('\x00' * 256))
+        self.assertEqual(decoder.buffered, 0)
+        decoder = WAMPStreamDecoder(max_frame_size=10)
+        with self.assertRaises(ValueError):
+            list(decoder.feed('[5, "a_much_longer_topic_than_allowed"]\n'))
+        with self.assertRaises(ValueError):
+            list(decoder.feed('[5, "t"]\n'))
+        decoder = WAMPStreamDecoder(max_frame_size=10)
+        with self.assertRaises(ValueError):
+            list(decoder.feed('[5, "long_topic'))
+        with self.assertRaises(ValueError):
+            list(decoder.feed('"]\n'))
+        self.assertEqual(decoder.buffered, 0)
+        decoder = WAMPStreamDecoder(max_frame_size=10)
+        self.assertEqual(list(decoder.feed('[5, "t"]\n')),
+                         [WAMPMessage.SUBSCRIBE('t')])
+
+    @unittest.skipUnless(wampserializer.msgpack, "msgpack is not installed")
+    def test_binary_serializer(self):
+        self.assertRaises(ValueError, WAMPStreamDecoder,
+                          WAMPFraming.NEWLINE, serializer='msgpack')
+        decoder = WAMPStreamDecoder(WAMPFraming.LENGTH_PREFIXED,
+                                    serializer='msgpack')
+        stream = ''.join(frame_message(m, WAMPFraming.LENGTH_PREFIXED,
+                                       'msgpack')
+                         for m in self.messages)
+        self.assertEqual(list(decoder.feed(stream)), self.messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
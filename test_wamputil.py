@@ -3,8 +3,9 @@ import unittest
 import weakref
 import inspect
 
+import wamputil
 from wamputil import (none_or_equal, iterablate, check_signature,
-                      WeaklyBoundCallable, AttributeFactoryMixin,
+                      WeaklyBoundCallable, LRUCache, AttributeFactoryMixin,
                       _EnumishMixin, EnumishStr, EnumishInt)
 
 
@@ -231,6 +232,49 @@ class TestCheckCallableClassSignature(unittest.TestCase):
             self.fail(e)
 
 
+class TestCheckSignatureCache(unittest.TestCase):
+
+    def test_cache_hits(self):
+
+        class MyClass(object):
+
+            def method(self, a, b=None):
+                pass
+
+        cache = wamputil._signature_cache
+        instance1 = MyClass()
+        instance2 = MyClass()
+        check_signature(instance1.method, min_args=1, max_args=2)
+        hits = cache.hits
+        check_signature(instance2.method, min_args=1, max_args=2)
+        check_signature(instance1.method, num_args=1)
+        self.assertEqual(cache.hits, hits + 2)
+        for i in range(2):
+            with self.assertRaises(TypeError) as cm:
+                check_signature(instance2.method, num_args=3)
+            self.assertIn("can't accept more than 2", str(cm.exception))
+            with self.assertRaises(TypeError) as cm:
+                check_signature(MyClass.method, num_args=1)
+            self.assertIn("requires at least 2", str(cm.exception))
+
+    def test_distinct_signatures(self):
+
+        def make(default):
+            def fn(a, b=default):
+                pass
+            return fn
+
+        check_signature(make(1), num_args=1)
+        fn = make(1)
+        fn.__defaults__ = None
+        self.assertRaises(TypeError, check_signature, fn, num_args=1)
+        wrapped = WeaklyBoundCallable(make(1))
+        check_signature(wrapped, num_args=5)
+        check_signature(AlwaysOne(), num_args=1)
+        self.assertRaises(TypeError, check_signature, AlwaysOne(), num_args=2)
+        self.assertRaises(TypeError, check_signature, len, num_args=1)
+
+
 class TestWeaklyBoundCallable(unittest.TestCase):
 
     def setUp(self):
@@ -268,6 +312,27 @@ class TestWeaklyBoundCallable(unittest.TestCase):
         gc.collect()
         self.assertEqual(my_ref(), None)
 
+    def test_on_dead(self):
+
+        class MyClass(object):
+
+            def my_method(self):
+                return self
+
+        dead = []
+        instance = MyClass()
+        wbm = WeaklyBoundCallable(instance.my_method, dead.append)
+        wbf = WeaklyBoundCallable(lambda: None, dead.append)
+        self.assertFalse(hasattr(wbm, '__dict__'))
+        self.assertEqual(wbm(), instance)
+        del instance
+        gc.collect()
+        self.assertEqual(dead, [wbm])
+        self.assertEqual(wbm.__self__, None)
+        del wbm
+        gc.collect()
+        self.assertEqual(len(dead), 1)
+
     def test_reverted(self):
 
         class MyClass(object):
@@ -359,6 +424,35 @@ class TestWeaklyBoundCallable(unittest.TestCase):
         self.assertEqual(dictionary[wb_1_1_c], 'wb_1_1_c')
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_lookup(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.lookup('a', str.upper), 'A')
+        self.assertEqual(cache.lookup('a', str.lower), 'A')
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2})
+        cache.clear()
+        self.assertEqual(cache.stats(),
+                         {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 2})
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.keys(), ['a', 'c'])
+        cache['a'] = 4
+        self.assertEqual(cache.keys(), ['c', 'a'])
+        self.assertEqual(cache.pop('a'), 4)
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+
+
 class TestAttributeFactoryMixin(unittest.TestCase):
 
     def test_attribute_factory(self):
@@ -567,6 +661,27 @@ class TestEnumishMixins(unittest.TestCase):
         new_adam = MyIntEnum(0)
         self.assertEqual(id(new_adam), id(adam))
 
+    def test_enumish_lookup_tables(self):
+
+        class MyIntEnum(EnumishInt):
+            _values = ["ADAM", "EVE", "CAIN"]
+
+        self.assertIs(MyIntEnum(1), MyIntEnum("EVE"))
+        self.assertIs(MyIntEnum(1), MyIntEnum.EVE)
+        with self.assertRaises(AttributeError):
+            MyIntEnum(-1)
+        with self.assertRaises(TypeError):
+            MyIntEnum(1.0)
+        eve = MyIntEnum.EVE
+        MyIntEnum._add_value_("ABEL")
+        self.assertIs(MyIntEnum(1), eve)
+        self.assertEqual(MyIntEnum(3).str, "ABEL")
+        MyIntEnum._remove_value_("ABEL")
+        with self.assertRaises(AttributeError):
+            MyIntEnum(3)
+        with self.assertRaises(AttributeError):
+            MyIntEnum("ABEL")
+
 
 if __name__ == '__main__':
     unittest.main()
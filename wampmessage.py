@@ -1,5 +1,7 @@
-import json
-from wamputil import iterablate, EnumishInt
+import re
+from json import JSONDecoder
+from wamputil import iterablate, EnumishInt, LRUCache
+from wampserializer import get_serializer
 
 
 class WAMPMessageType(EnumishInt):
@@ -17,140 +19,269 @@ class WAMPMessageType(EnumishInt):
 
 class WAMPMessageMetaclass(type):
 
-    def __getattribute__(cls, name):
-        try:
-            return type.__getattribute__(cls, name)
-        except AttributeError:
-            message_type = getattr(WAMPMessageType, name)
-            try:
-                assert cls == WAMPMessage, "cannot be called from a subclass"
-                return cls._sc[message_type]
-            except KeyError as e:
-                raise AttributeError("%s object has no attribute %s" %
-                                     cls.__name__, name)
+    """
+    resolves WAMPMessage.<TYPE> for message types that have no bound
+    constructor
+
+    Constructors for registered message classes are bound directly on
+    WAMPMessage (see WAMPMessage._register), so this is only consulted
+    when normal attribute lookup fails.
+    """
+
+    def __getattr__(cls, name):
+        message_type = getattr(WAMPMessageType, name)
+        assert cls == WAMPMessage, "cannot be called from a subclass"
+        message_cls = _message_class(message_type)
+        if message_cls is None:
+            raise AttributeError("%s object has no attribute %s" %
+                                 (cls.__name__, name))
+        return message_cls
+
+
+# message classes indexed by int(message type); see WAMPMessage._register
+_message_classes = []
+
+
+def _message_class(message_type):
+    try:
+        if message_type >= 0:
+            return _message_classes[message_type]
+    except (IndexError, TypeError):
+        pass
+    return None
+
+
+_new = object.__new__
+_setattr = object.__setattr__
 
 
 class WAMPMessage(object):
 
+    """
+    base class for WAMP messages
+
+    Messages are slotted: each subclass lists its fields in `_fields`
+    (which doubles as its `__slots__`), and the message type is a class
+    attribute.  Equality compares those fields directly.  `_routing` names
+    the leading fields that identify where a message goes; the remaining
+    fields are its payload.  Constructors
+    fill the slots with object.__setattr__, bypassing the invalidation
+    in __setattr__, since a new message has nothing memoized.
+
+    `json` and the results of `dumps` are memoized on the message, and
+    discarded when any attribute is assigned; treat the `json` list as
+    read-only.
+    """
+
     __metaclass__ = WAMPMessageMetaclass
+    __slots__ = ('_json', '_wire')
     _sc = dict()
+    _type = None
+    _fields = ()
+    _routing = ()
 
     def __new__(cls, type=None, *args, **kwargs):
-        if cls == WAMPMessage:
-            assert type in cls._sc, "unrecognized message type"
-            return cls._sc[type](*args, **kwargs)
+        if cls is WAMPMessage:
+            message_cls = _message_class(type)
+            assert message_cls is not None, "unrecognized message type"
+            return message_cls(*args, **kwargs)
         else:
-            return super(WAMPMessage, cls).__new__(cls)
+            return _new(cls)
 
     @classmethod
-    def loads(cls, in_string):
+    def _register(cls, message_cls):
+        """
+        makes message_cls the class for its message type, both for
+        decoding and as WAMPMessage.<TYPE>
+        """
+        message_type = message_cls._type
+        cls._sc[message_type] = message_cls
+        if len(_message_classes) <= message_type:
+            _message_classes.extend(
+                [None] * (message_type + 1 - len(_message_classes)))
+        _message_classes[message_type] = message_cls
+        setattr(cls, message_type.str, message_cls)
+
+    @classmethod
+    def loads(cls, in_string, serializer=None, lazy=False):
+        """
+        decodes a message from its wire form
+
+        If `lazy` is True (and the serializer produces JSON text), only the
+        message type and routing fields (call_id, proc_uri, topic_uri) are
+        decoded up front; see WAMPMessageLazyMixin
+        """
         assert cls == WAMPMessage, "cannot be called from a subclass"
-        in_object = json.loads(in_string)
-        return WAMPMessage(*in_object)
+        serializer = get_serializer(serializer)
+        if lazy and serializer.raw_json:
+            message = _loads_lazy(in_string, serializer)
+            if message is not None:
+                return message
+        in_object = serializer.loads(in_string)
+        message_cls = _message_class(in_object[0])
+        assert message_cls is not None, "unrecognized message type"
+        return message_cls(*in_object[1:])
+
+    def dumps(self, serializer=None):
+        """
+        returns the wire form of the message
+
+        The result is memoized per serializer, so a message that is sent
+        to many recipients is only encoded once.  Assigning to any of the
+        message's attributes discards the memoized forms; mutating a field
+        in place (e.g., appending to `args`) does not.
+        """
+        serializer = get_serializer(serializer)
+        wire = getattr(self, '_wire', None)
+        if wire is None:
+            wire = dict()
+            _setattr(self, '_wire', wire)
+        try:
+            return wire[serializer]
+        except KeyError:
+            data = wire[serializer] = self._encode(serializer)
+            return data
+
+    def _encode(self, serializer):
+        return serializer.dumps(self.json)
+
+    def _prefix(self, serializer):
+        """
+        returns the JSON text of the message up to its payload, i.e., the
+        opening bracket, type and routing fields, and a trailing separator
+        """
+        head = serializer.dumps(
+            [self._type] + [getattr(self, name) for name in self._routing])
+        return head[:head.rindex(']')] + ', '
+
+    def __setattr__(self, name, value):
+        _setattr(self, name, value)
+        _setattr(self, '_json', None)
+        _setattr(self, '_wire', None)
 
     @property
     def type(self):
-        return getattr(self, '_type', None)
+        return self._type
 
     @property
     def json(self):
-        return [self.type] + self.wamp_args
+        json = getattr(self, '_json', None)
+        if json is None:
+            json = [self._type] + self.wamp_args
+            _setattr(self, '_json', json)
+        return json
 
     def __hash__(self):
-        return int(self.type) if self.type is not None else -1
+        return int(self._type) if self._type is not None else -1
 
     def __eq__(self, other):
-        return (isinstance(other, WAMPMessage) and
-                self.__hash__() == other.__hash__() and
-                self.json == other.json)
+        if self is other:
+            return True
+        if not isinstance(other, WAMPMessage) or self._type != other._type:
+            return False
+        for name in self._fields:
+            if getattr(self, name, None) != getattr(other, name, None):
+                return False
+        return True
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __str__(self):
-        return json.dumps(self.json, default=str)
+        return self.dumps()
 
-    def __getnewargs__(self):
-        return tuple(self.wamp_args)
+    def __reduce__(self):
+        return (WAMPMessage, (int(self._type),) + tuple(self.wamp_args))
 
 
 class WAMPMessageWelcome(WAMPMessage):
 
+    __slots__ = _fields = ('session_id', 'protocol_version', 'server_ident')
+    _type = WAMPMessageType.WELCOME
+
     def __new__(cls, session_id, protocol_version=1, server_ident=1):
-        self = super(WAMPMessageWelcome, cls).__new__(WAMPMessageWelcome)
-        self._type = WAMPMessageType.WELCOME
-        self.session_id = session_id
-        self.protocol_version = protocol_version
-        self.server_ident = server_ident
+        self = _new(WAMPMessageWelcome)
+        _setattr(self, 'session_id', session_id)
+        _setattr(self, 'protocol_version', protocol_version)
+        _setattr(self, 'server_ident', server_ident)
         return self
 
     @property
     def wamp_args(self):
         return [self.session_id, self.protocol_version, self.server_ident]
 
-WAMPMessage._sc[WAMPMessageType.WELCOME] = WAMPMessageWelcome
+WAMPMessage._register(WAMPMessageWelcome)
 
 
 class WAMPMessagePrefix(WAMPMessage):
 
+    __slots__ = _fields = ('prefix', 'uri')
+    _type = WAMPMessageType.PREFIX
+
     def __new__(cls, prefix, uri):
-        self = super(WAMPMessagePrefix, cls).__new__(WAMPMessagePrefix)
-        self._type = WAMPMessageType.PREFIX
-        self.prefix = prefix
-        self.uri = uri
+        self = _new(WAMPMessagePrefix)
+        _setattr(self, 'prefix', prefix)
+        _setattr(self, 'uri', uri)
         return self
 
     @property
     def wamp_args(self):
         return [self.prefix, self.uri]
 
-WAMPMessage._sc[WAMPMessageType.PREFIX] = WAMPMessagePrefix
+WAMPMessage._register(WAMPMessagePrefix)
 
 
 class WAMPMessageCall(WAMPMessage):
 
+    __slots__ = _fields = ('call_id', 'proc_uri', 'args')
+    _type = WAMPMessageType.CALL
+    _routing = ('call_id', 'proc_uri')
+
     def __new__(cls, call_id, proc_uri, *args):
-        self = super(WAMPMessageCall, cls).__new__(WAMPMessageCall)
-        self._type = WAMPMessageType.CALL
-        self.call_id = call_id
-        self.proc_uri = proc_uri
-        self.args = list(args)
+        self = _new(WAMPMessageCall)
+        _setattr(self, 'call_id', call_id)
+        _setattr(self, 'proc_uri', proc_uri)
+        _setattr(self, 'args', list(args))
         return self
 
     @property
     def wamp_args(self):
         return [self.call_id, self.proc_uri] + self.args
 
-WAMPMessage._sc[WAMPMessageType.CALL] = WAMPMessageCall
+WAMPMessage._register(WAMPMessageCall)
 
 
 class WAMPMessageCallResult(WAMPMessage):
 
+    __slots__ = _fields = ('call_id', 'result')
+    _type = WAMPMessageType.CALLRESULT
+    _routing = ('call_id',)
+
     def __new__(cls, call_id, result):
-        self = (super(WAMPMessageCallResult, cls).
-                __new__(WAMPMessageCallResult))
-        self._type = WAMPMessageType.CALLRESULT
-        self.call_id = call_id
-        self.result = result
+        self = _new(WAMPMessageCallResult)
+        _setattr(self, 'call_id', call_id)
+        _setattr(self, 'result', result)
         return self
 
     @property
     def wamp_args(self):
         return [self.call_id, self.result]
 
-WAMPMessage._sc[WAMPMessageType.CALLRESULT] = WAMPMessageCallResult
+WAMPMessage._register(WAMPMessageCallResult)
 
 
 class WAMPMessageCallError(WAMPMessage):
 
+    __slots__ = _fields = ('call_id', 'error_uri', 'error_desc',
+                          'error_details')
+    _type = WAMPMessageType.CALLERROR
+
     def __new__(cls, call_id, error_uri, error_desc, error_details=None):
-        self = (super(WAMPMessageCallError, cls).
-                __new__(WAMPMessageCallError))
-        self._type = WAMPMessageType.CALLERROR
-        self.call_id = call_id
-        self.error_uri = error_uri
-        self.error_desc = error_desc
-        self.error_details = error_details
+        self = _new(WAMPMessageCallError)
+        _setattr(self, 'call_id', call_id)
+        _setattr(self, 'error_uri', error_uri)
+        _setattr(self, 'error_desc', error_desc)
+        _setattr(self, 'error_details', error_details)
         return self
 
     @property
@@ -158,54 +289,61 @@ class WAMPMessageCallError(WAMPMessage):
         return ([self.call_id, self.error_uri, self.error_desc] +
                 ([] if self.error_details is None else [self.error_details]))
 
-WAMPMessage._sc[WAMPMessageType.CALLERROR] = WAMPMessageCallError
+WAMPMessage._register(WAMPMessageCallError)
 
 
 class WAMPMessageSubscribe(WAMPMessage):
 
+    __slots__ = _fields = ('topic_uri',)
+    _type = WAMPMessageType.SUBSCRIBE
+
     def __new__(cls, topic_uri):
-        self = (super(WAMPMessageSubscribe, cls).
-                __new__(WAMPMessageSubscribe))
-        self._type = WAMPMessageType.SUBSCRIBE
-        self.topic_uri = topic_uri
+        self = _new(WAMPMessageSubscribe)
+        _setattr(self, 'topic_uri', topic_uri)
         return self
 
     @property
     def wamp_args(self):
         return [self.topic_uri]
 
-WAMPMessage._sc[WAMPMessageType.SUBSCRIBE] = WAMPMessageSubscribe
+WAMPMessage._register(WAMPMessageSubscribe)
 
 
 class WAMPMessageUnsubscribe(WAMPMessage):
 
+    __slots__ = _fields = ('topic_uri',)
+    _type = WAMPMessageType.UNSUBSCRIBE
+
     def __new__(cls, topic_uri):
-        self = (super(WAMPMessageUnsubscribe, cls).
-                __new__(WAMPMessageUnsubscribe))
-        self._type = WAMPMessageType.UNSUBSCRIBE
-        self.topic_uri = topic_uri
+        self = _new(WAMPMessageUnsubscribe)
+        _setattr(self, 'topic_uri', topic_uri)
         return self
 
     @property
     def wamp_args(self):
         return [self.topic_uri]
 
-WAMPMessage._sc[WAMPMessageType.UNSUBSCRIBE] = WAMPMessageUnsubscribe
+WAMPMessage._register(WAMPMessageUnsubscribe)
 
 
 class WAMPMessagePublish(WAMPMessage):
 
+    __slots__ = _fields = ('topic_uri', 'event', 'exclude_me', 'exclude',
+                          'eligible')
+    _type = WAMPMessageType.PUBLISH
+    _routing = ('topic_uri',)
+
     def __new__(cls, topic_uri, event, exclude=None, eligible=None):
-        self = super(WAMPMessagePublish, cls).__new__(WAMPMessagePublish)
-        self._type = WAMPMessageType.PUBLISH
-        self.topic_uri = topic_uri
-        self.event = event
+        self = _new(WAMPMessagePublish)
+        _setattr(self, 'topic_uri', topic_uri)
+        _setattr(self, 'event', event)
         if isinstance(exclude, bool):
             assert eligible is None, "eligible list requires exclude *list*"
-            self.exclude_me = True
+            _setattr(self, 'exclude_me', True)
         else:
-            self.exclude = iterablate(exclude, wrapper_cls=list)
-            self.eligible = iterablate(eligible, wrapper_cls=list)
+            _setattr(self, 'exclude', iterablate(exclude, wrapper_cls=list))
+            _setattr(self, 'eligible',
+                     iterablate(eligible, wrapper_cls=list))
         return self
 
     @property
@@ -220,20 +358,179 @@ class WAMPMessagePublish(WAMPMessage):
             filters = []
         return [self.topic_uri, self.event] + filters
 
-WAMPMessage._sc[WAMPMessageType.PUBLISH] = WAMPMessagePublish
+WAMPMessage._register(WAMPMessagePublish)
+
+
+def _event_prefix(key):
+    serializer, topic_uri = key
+    head = serializer.dumps([WAMPMessageType.EVENT, topic_uri])
+    return head[:head.rindex(']')] + ', '
 
 
 class WAMPMessageEvent(WAMPMessage):
 
+    __slots__ = _fields = ('topic_uri', 'event')
+    _type = WAMPMessageType.EVENT
+    _routing = ('topic_uri',)
+
+    # encoded '[8, "<topic_uri>", ' prefixes, keyed by (serializer, topic)
+    prefix_cache = LRUCache(1024)
+
     def __new__(cls, topic_uri, event):
-        self = super(WAMPMessageEvent, cls).__new__(WAMPMessageEvent)
-        self._type = WAMPMessageType.EVENT
-        self.topic_uri = topic_uri
-        self.event = event
+        self = _new(WAMPMessageEvent)
+        _setattr(self, 'topic_uri', topic_uri)
+        _setattr(self, 'event', event)
         return self
 
     @property
     def wamp_args(self):
         return [self.topic_uri, self.event]
 
-WAMPMessage._sc[WAMPMessageType.EVENT] = WAMPMessageEvent
+    def _prefix(self, serializer):
+        return self.prefix_cache.lookup((serializer, self.topic_uri),
+                                        _event_prefix)
+
+    def _encode(self, serializer):
+        if serializer.raw_json:
+            return (self._prefix(serializer) + serializer.dumps(self.event) +
+                    ']')
+        return super(WAMPMessageEvent, self)._encode(serializer)
+
+WAMPMessage._register(WAMPMessageEvent)
+
+
+# Lazy decoding
+
+class WAMPMessageLazyMixin(object):
+
+    """
+    a message decoded from JSON text with its payload left unparsed
+
+    The routing fields (`_routing`) are decoded eagerly; the rest of the
+    array is kept as the raw JSON slice `_payload`, and is only parsed
+    when one of the `_lazy` fields is read or assigned.
+
+    Until an attribute is assigned, `dumps` with a raw_json serializer
+    returns the original text unchanged.  After a routing field has been
+    assigned (e.g., a forwarded CALL with an expanded proc_uri), a still
+    unparsed payload is spliced back in without being re-encoded.
+    """
+
+    __slots__ = ()
+    _lazy = ()
+
+    @classmethod
+    def _from_raw(cls, routing_values, payload, raw, serializer):
+        self = _new(cls)
+        for name, value in zip(cls._routing, routing_values):
+            _setattr(self, name, value)
+        _setattr(self, '_payload', payload)
+        _setattr(self, '_raw', raw)
+        _setattr(self, '_serializer', serializer)
+        return self
+
+    @property
+    def raw_payload(self):
+        """ the unparsed payload, or None once it has been parsed """
+        return self._payload
+
+    def _materialize(self):
+        payload = self._payload
+        _setattr(self, '_payload', None)
+        values = self._serializer.loads('[' + payload + ']')
+        routing_values = [getattr(self, name) for name in self._routing]
+        full = self._eager_cls(*(routing_values + values))
+        for name, slot in self._lazy_slots:
+            try:
+                slot.__set__(self, slot.__get__(full, self._eager_cls))
+            except AttributeError:
+                pass
+
+    def _encode(self, serializer):
+        if serializer.raw_json:
+            if self._raw is not None:
+                return self._raw
+            payload = self._payload
+            if payload:
+                return self._prefix(serializer) + payload + ']'
+            if payload is not None:
+                return serializer.dumps([self._type] + [
+                    getattr(self, name) for name in self._routing])
+        return super(WAMPMessageLazyMixin, self)._encode(serializer)
+
+    def __setattr__(self, name, value):
+        super(WAMPMessageLazyMixin, self).__setattr__(name, value)
+        _setattr(self, '_raw', None)
+
+
+def _lazy_field(name, slot):
+    def get(self):
+        if self._payload is not None:
+            self._materialize()
+        return slot.__get__(self, type(self))
+
+    def set(self, value):
+        if self._payload is not None:
+            self._materialize()
+        slot.__set__(self, value)
+
+    return property(get, set, doc="lazily decoded '%s'" % name)
+
+
+def _lazy_message_class(message_cls):
+    lazy = tuple(name for name in message_cls._fields
+                 if name not in message_cls._routing)
+    slots = [(name, message_cls.__dict__[name]) for name in lazy]
+    attrs = dict(__slots__=('_raw', '_payload', '_serializer'),
+                 _lazy=lazy, _lazy_slots=slots, _eager_cls=message_cls)
+    attrs.update((name, _lazy_field(name, slot)) for name, slot in slots)
+    name = message_cls.__name__.replace('WAMPMessage', 'WAMPMessageLazy')
+    return type(message_cls)(name, (WAMPMessageLazyMixin, message_cls),
+                             attrs)
+
+
+WAMPMessageLazyCall = _lazy_message_class(WAMPMessageCall)
+WAMPMessageLazyCallResult = _lazy_message_class(WAMPMessageCallResult)
+WAMPMessageLazyPublish = _lazy_message_class(WAMPMessagePublish)
+WAMPMessageLazyEvent = _lazy_message_class(WAMPMessageEvent)
+
+_lazy_message_classes = dict((cls._type, cls) for cls in
+                             (WAMPMessageLazyCall, WAMPMessageLazyCallResult,
+                              WAMPMessageLazyPublish, WAMPMessageLazyEvent))
+
+_json_decoder = JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_message_type_re = re.compile(r'[ \t\n\r]*\[[ \t\n\r]*(\d+)')
+
+
+def _loads_lazy(in_string, serializer):
+    """
+    returns a lazily decoded message, or None if the message type has no
+    lazy form
+    """
+    match = _message_type_re.match(in_string)
+    if match is None:
+        return None
+    message_cls = _lazy_message_classes.get(int(match.group(1)))
+    if message_cls is None:
+        return None
+    end = in_string.rindex(']')
+    if in_string[end + 1:].strip():
+        raise ValueError("extra data after message")
+    idx = match.end()
+    routing_values = []
+    for name in message_cls._routing:
+        idx = _whitespace.match(in_string, idx).end()
+        if in_string[idx] != ',':
+            raise ValueError("%s message is missing '%s'" %
+                             (message_cls._type.str, name))
+        idx = _whitespace.match(in_string, idx + 1).end()
+        value, idx = _json_decoder.raw_decode(in_string, idx)
+        routing_values.append(value)
+    idx = _whitespace.match(in_string, idx).end()
+    if idx < end:
+        if in_string[idx] != ',':
+            raise ValueError("malformed %s message" % message_cls._type.str)
+        idx += 1
+    return message_cls._from_raw(routing_values, in_string[idx:end].strip(),
+                                 in_string, serializer)
@@ -0,0 +1,140 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class WAMPSerializer(object):
+
+    """
+    converts between the `json` list form of a WAMPMessage and its
+    representation on the wire
+
+    Subclasses set `name` (the key the serializer is registered under),
+    `binary` (True if the wire form is not text, and so cannot be
+    carried in newline-delimited frames) and `raw_json` (True if the wire
+    form is JSON text, so fragments of it can be sliced out and spliced
+    back in unparsed; see WAMPMessage.loads(lazy=True)).
+    """
+
+    name = NotImplemented
+    binary = False
+    raw_json = False
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class JSONSerializer(WAMPSerializer):
+
+    """ the stdlib json module; always available """
+
+    name = 'json'
+    raw_json = True
+
+    # json.dumps builds a new encoder per call when given `default`
+    _encoder = json.JSONEncoder(default=str)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UJSONSerializer(WAMPSerializer):
+
+    """
+    ujson, if installed
+
+    NB: depending on the ujson version, objects that are not JSON types
+    are either rejected or encoded as empty objects rather than as their
+    `str`; rejected values fall back to the stdlib json module
+    """
+
+    name = 'ujson'
+    raw_json = True
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return json.dumps(obj, default=str)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class MsgPackSerializer(WAMPSerializer):
+
+    """ msgpack, if installed; a binary wire form """
+
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, default=str, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+_serializers = dict()
+_default_serializer = [None]
+
+
+def register_serializer(serializer, name=None):
+    """ makes `serializer` available by `name` (default: serializer.name) """
+    _serializers[name or serializer.name] = serializer
+
+
+def available_serializers():
+    """ returns the names of all registered serializers """
+    return sorted(_serializers.keys())
+
+
+def get_serializer(serializer=None):
+    """
+    resolves `serializer` to a WAMPSerializer instance
+
+    `serializer` may be a registered name, a WAMPSerializer instance
+    (returned unchanged) or None, for the process-wide default
+    """
+    if serializer is None:
+        return _default_serializer[0]
+    if isinstance(serializer, WAMPSerializer):
+        return serializer
+    try:
+        return _serializers[serializer]
+    except KeyError:
+        raise ValueError("unrecognized serializer: '%s'" % serializer)
+
+
+def set_default_serializer(serializer):
+    """ sets the process-wide serializer used when none is specified """
+    _default_serializer[0] = get_serializer(serializer)
+
+
+register_serializer(JSONSerializer())
+if ujson is not None:
+    register_serializer(UJSONSerializer())
+if msgpack is not None:
+    register_serializer(MsgPackSerializer())
+
+# 'fastjson' is the fastest JSON implementation that is installed
+for _name in ('ujson', 'json'):
+    if _name in _serializers:
+        register_serializer(_serializers[_name], 'fastjson')
+        break
+
+set_default_serializer('json')
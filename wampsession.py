@@ -1,41 +1,220 @@
 import uuid
-from wamputil import check_signature, WeaklyBoundCallable
+from collections import deque
+from functools import partial
+from threading import Lock
+from wamputil import check_signature, WeaklyBoundCallable, when_done
 from wampmessage import WAMPMessage, WAMPMessageType
 from wampexc import WAMPError
+from wampserializer import get_serializer
 from pubsub import PubSub
 
+try:
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
+
+
+class WAMPSessionMetaclass(type):
+
+    """
+    builds each session class's handler table when the class is defined
+
+    `_handlers` holds the class's _handle_<TYPE> function (including any
+    override from a subclass or mixin) for each message type, indexed by
+    int(message type), so that handle_wamp_message needs neither a string
+    nor an attribute lookup.  A handler assigned on an instance is not
+    used.
+    """
+
+    def __init__(cls, name, bases, namespace):
+        super(WAMPSessionMetaclass, cls).__init__(name, bases, namespace)
+        handlers = []
+        for type_name in WAMPMessageType._values:
+            handler = getattr(cls, '_handle_' + type_name, None)
+            handlers.append(getattr(handler, '__func__', handler))
+        cls._handlers = tuple(handlers)
+
+
+class _OffloadedProcedure(object):
+
+    """
+    a registered procedure that runs on an executor; calling it returns
+    a concurrent.futures.Future
+
+    At most `max_concurrent` calls (if given) run at once; later calls
+    wait, in order, for one of them to finish.
+    """
+
+    def __init__(self, procedure, executor, max_concurrent=None):
+        self.procedure = procedure
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self._running = 0
+        # (Future, args) of the calls waiting for a slot
+        self._waiting = deque()
+        # slots released while another thread (or an outer call) was
+        # handing them out; see _finished
+        self._released = 0
+        self._draining = False
+        self._lock = Lock()
+
+    def __call__(self, *args):
+        if self.max_concurrent is None:
+            return self._submit(args)
+        future = Future()
+        with self._lock:
+            if self._running >= self.max_concurrent:
+                self._waiting.append((future, args))
+                return future
+            self._running += 1
+        if not self._start(future, args):
+            self._finished()
+        return future
+
+    def _submit(self, args):
+        # the original callable, so that a process pool can pickle it
+        return self.executor.submit(self.procedure.reverted(), *args)
+
+    def _start(self, future, args):
+        """ submits a call; returns False if the executor refused it """
+        try:
+            submitted = self._submit(args)
+        except Exception as e:
+            future.set_exception(e)
+            return False
+        submitted.add_done_callback(partial(self._done, future))
+        return True
+
+    def _done(self, future, submitted):
+        try:
+            result = submitted.result()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        self._finished()
+
+    def _finished(self):
+        """
+        hands a finished call's slot to the next waiting call
+
+        Slots are handed out in a loop, by one thread at a time, rather
+        than by recursing: a call that fails to submit, or that finishes
+        as soon as it is submitted, releases its slot again from within
+        _start.
+        """
+        with self._lock:
+            self._released += 1
+            if self._draining:
+                return
+            self._draining = True
+        while True:
+            with self._lock:
+                if not self._released:
+                    self._draining = False
+                    return
+                self._released -= 1
+                if not self._waiting:
+                    self._running -= 1
+                    continue
+                future, args = self._waiting.popleft()
+            if not self._start(future, args):
+                with self._lock:
+                    self._released += 1
+
 
 class WAMPSession(object):
 
+    __metaclass__ = WAMPSessionMetaclass
+    # the last CALL callback passed to handle_wamp_message, checked and
+    # weakly bound
+    _call_callback = None
+
     cls_pubsub = PubSub('WAMPSessions')
     bad_prefix_uri = "http://wamp.ws/spec/#prefix_message"
     unrecognized_proc_uri = "http://wamp.ws/spec/#call_message"
 
-    def __init__(self, pubsub=None, prefixes=None, procedures=None):
+    def __init__(self, pubsub=None, prefixes=None, procedures=None,
+                 serializer=None):
         self._session_id = str(uuid.uuid4())
         self.pubsub = pubsub or self.cls_pubsub
         self.prefixes = prefixes or dict()
         self.procedures = procedures or dict()
+        self.serializer = get_serializer(serializer)
 
     @property
     def session_id(self):
         return self._session_id
 
+    @property
+    def queue_stats(self):
+        """
+        this session's event queue depth and drop counters (see
+        dispatch.Dispatcher.stats), or None if events are delivered
+        synchronously
+        """
+        dispatcher = self.pubsub.dispatcher
+        if dispatcher is None:
+            return None
+        return dispatcher.stats(self.session_id)
+
     def handle_wamp_message(self, message, callback=None):
-        handler_name = "_handle_" + message.type.str
-        method = getattr(self, handler_name)
-        if method:
-            args = [message]
-            if message.type == WAMPMessageType.CALL and callback is not None:
-                check_signature(callback, num_args=1)
-                args.append(WeaklyBoundCallable(callback))
-            method(*args)
+        handler = self._handlers[message.type]
+        if handler is None:
+            raise AttributeError("%s has no handler for %s messages" %
+                                 (self.__class__.__name__, message.type.str))
+        if callback is not None and message.type == WAMPMessageType.CALL:
+            handler(self, message, self._checked_call_callback(callback))
+        else:
+            handler(self, message)
+
+    def _checked_call_callback(self, callback):
+        """
+        returns `callback`, checked and weakly bound; a transport passes
+        the same callback (e.g., the same bound method) with every CALL,
+        so the last one is kept and reused
+        """
+        cached = self._call_callback
+        if cached is not None and \
+                cached.__func__ is getattr(callback, '__func__', callback) \
+                and cached.__self__ is getattr(callback, '__self__', None):
+            return cached
+        check_signature(callback, num_args=1)
+        self._call_callback = WeaklyBoundCallable(callback)
+        return self._call_callback
+
+    # Serialization
+    def loads(self, data, lazy=False):
+        return WAMPMessage.loads(data, self.serializer, lazy)
+
+    def dumps(self, message):
+        return message.dumps(self.serializer)
 
     # RPC Registration
-    def register_procedure(self, uri, procedure=None):
+    def register_procedure(self, uri, procedure=None, executor=None,
+                           max_concurrent=None):
+        """
+        executor: if given (e.g., a concurrent.futures ThreadPoolExecutor
+        or ProcessPoolExecutor), the procedure runs on it, rather than on
+        the thread handling the CALL, and the response is sent when it
+        finishes (see call_soon)
+        max_concurrent: the most calls to the procedure to run on the
+        executor at once; the rest wait their turn
+        """
         procedure = procedure or (lambda *args: None)
         check_signature(procedure, min_args=0)
-        self.procedures[uri] = WeaklyBoundCallable(procedure)
+        procedure = WeaklyBoundCallable(procedure)
+        if executor is not None:
+            if max_concurrent is not None and max_concurrent < 1:
+                raise ValueError("max_concurrent must be at least 1")
+            if max_concurrent is not None and Future is None:
+                raise ValueError("max_concurrent requires "
+                                 "concurrent.futures")
+            procedure = _OffloadedProcedure(procedure, executor,
+                                            max_concurrent)
+        elif max_concurrent is not None:
+            raise ValueError("max_concurrent requires an executor")
+        self.procedures[uri] = procedure
 
     def expand_uri(self, uri):
         try:
@@ -72,6 +251,40 @@ class WAMPSession(object):
     def send_wamp_message(self):
         del self._send_wamp_message
 
+    # send_wamp_messages (optional; sends a list of messages at once)
+    @property
+    def send_wamp_messages(self):
+        return self._send_wamp_messages
+
+    @send_wamp_messages.setter
+    def send_wamp_messages(self, value):
+        check_signature(value, num_args=1)
+        self._send_wamp_messages = WeaklyBoundCallable(value)
+
+    @send_wamp_messages.deleter
+    def send_wamp_messages(self):
+        del self._send_wamp_messages
+
+    # call_soon (optional; e.g., loop.call_soon_threadsafe)
+    @property
+    def call_soon(self):
+        """
+        called as call_soon(fn, arg) to send the response to a CALL whose
+        procedure finished asynchronously (e.g., on an executor); set it
+        to have responses sent from the thread or event loop that owns
+        the transport, rather than from wherever the procedure finished
+        """
+        return self._call_soon
+
+    @call_soon.setter
+    def call_soon(self, value):
+        check_signature(value, num_args=2)
+        self._call_soon = WeaklyBoundCallable(value)
+
+    @call_soon.deleter
+    def call_soon(self):
+        del self._call_soon
+
     # callresult_callback
     @property
     def callresult_callback(self):
@@ -126,17 +339,55 @@ class WAMPSession(object):
         return procedure(*(message.args))
 
     def _handle_CALL(self, message, callback=None):
+        """
+        calls the procedure for `message` and sends its CALLRESULT (or
+        CALLERROR) to `callback`, or else with send_wamp_message
+
+        A procedure that returns None sends no response (it is expected
+        to respond some other way).  A procedure may also return a Future
+        or a Deferred (see wamputil.when_done), to
+        respond once that completes, so that other messages, including
+        other CALLs, are handled in the meantime.  Procedures registered
+        with an executor return a Future this way.
+        """
         try:
             result = self._invoke_proc_for_message(message)
             if result is None:
                 return
+            on_result = partial(self._call_result, message, callback)
+            on_error = partial(self._call_error, message, callback)
+            call_soon = getattr(self, '_call_soon', None)
+            if call_soon is not None:
+                on_result = partial(call_soon, on_result)
+                on_error = partial(call_soon, on_error)
+            if when_done(result, on_result, on_error):
+                return
+            response = WAMPMessage.CALLRESULT(message.call_id, result)
+        except Exception as e:
+            response = self._error_response(message, e)
+        self._send_call_response(response, callback)
+
+    def _call_result(self, message, callback, result):
+        try:
             response = WAMPMessage.CALLRESULT(message.call_id, result)
-        except WAMPError as e:
-            response = WAMPMessage.CALLERROR(message.call_id, e.error_uri,
-                                             e.error_desc, e.error_details)
         except Exception as e:
-            response = WAMPMessage.CALLERROR(
-                message.call_id, 'errors/unknown', 'unknown error', e.args)
+            response = self._error_response(message, e)
+        self._send_call_response(response, callback)
+
+    def _call_error(self, message, callback, error):
+        self._send_call_response(self._error_response(message, error),
+                                 callback)
+
+    @staticmethod
+    def _error_response(message, error):
+        if isinstance(error, WAMPError):
+            return WAMPMessage.CALLERROR(message.call_id, error.error_uri,
+                                         error.error_desc,
+                                         error.error_details)
+        return WAMPMessage.CALLERROR(
+            message.call_id, 'errors/unknown', 'unknown error', error.args)
+
+    def _send_call_response(self, response, callback):
         if callback is not None:
             callback(response)
         else:
@@ -149,12 +400,26 @@ class WAMPSession(object):
         self.callerror_callback(message)
 
     # Pub-Sub
-    def _pubsub_callback(self, topic, event):
-        self.send_wamp_message(WAMPMessage.EVENT(topic, event))
+    def _pubsub_callback(self, publication):
+        # every recipient shares one EVENT message (and so its wire form)
+        self.send_wamp_message(publication.memo(WAMPMessage.EVENT))
+
+    def _pubsub_batch_callback(self, publications):
+        # events from PubSub.publish_many go out in one call, if the
+        # transport can take them that way
+        messages = [publication.memo(WAMPMessage.EVENT)
+                    for publication in publications]
+        send_wamp_messages = getattr(self, '_send_wamp_messages', None)
+        if send_wamp_messages is not None:
+            send_wamp_messages(messages)
+        else:
+            for message in messages:
+                self.send_wamp_message(message)
 
     def _handle_SUBSCRIBE(self, message):
         self.pubsub.subscribe(self, self.session_id, message.topic_uri,
-                              self._pubsub_callback)
+                              self._pubsub_callback, publication=True,
+                              batch=self._pubsub_batch_callback)
 
     def _handle_UNSUBSCRIBE(self, message):
         self.pubsub.unsubscribe(self, self.session_id, message.topic_uri,
@@ -0,0 +1,148 @@
+import struct
+from wamputil import EnumishStr
+from wampmessage import WAMPMessage
+from wampserializer import get_serializer
+
+
+class WAMPFraming(EnumishStr):
+
+    _values = ['NEWLINE',
+               'LENGTH_PREFIXED']
+
+
+_length_header = struct.Struct('!I')
+
+
+def _check_framing(framing, serializer):
+    if serializer.binary and framing == WAMPFraming.NEWLINE:
+        raise ValueError("%s serializer cannot be used with NEWLINE framing"
+                         % serializer.name)
+
+
+def frame_message(message, framing=WAMPFraming.NEWLINE, serializer=None):
+    """ serializes a message and wraps it in the requested framing """
+    framing = WAMPFraming(framing)
+    serializer = get_serializer(serializer)
+    _check_framing(framing, serializer)
+    frame = message.dumps(serializer)
+    if framing == WAMPFraming.LENGTH_PREFIXED:
+        return _length_header.pack(len(frame)) + frame
+    return frame + '\n'
+
+
+class WAMPStreamDecoder(object):
+
+    """
+    incrementally decodes a byte stream into WAMPMessage instances
+
+    Bytes are handed to `feed` as they arrive from the transport, in
+    chunks of any size; complete frames are decoded and yielded, and a
+    trailing partial frame is buffered until the rest of it arrives.
+
+    Two framings are understood: NEWLINE, where each message is a single
+    line of JSON, and LENGTH_PREFIXED, where each message is preceded by
+    its length as a 4-byte big-endian unsigned integer.
+
+    Every byte is examined at most once: the decoder remembers how far it
+    has searched for a delimiter (or the length of the frame it is waiting
+    for) across calls to `feed`.
+
+    Frames are decoded with `serializer` (see wampserializer); binary
+    serializers require LENGTH_PREFIXED framing.  If `lazy` is True,
+    payloads are left unparsed (see WAMPMessage.loads).
+
+    A frame longer than `max_frame_size` bytes (complete or not) fails
+    the decoder: the buffered bytes are discarded, later data is ignored,
+    and every iteration raises ValueError, as the stream can no longer
+    be framed.
+    """
+
+    def __init__(self, framing=WAMPFraming.NEWLINE, max_frame_size=None,
+                 serializer=None, lazy=False):
+        self.framing = WAMPFraming(framing)
+        self.serializer = get_serializer(serializer)
+        self.lazy = lazy
+        _check_framing(self.framing, self.serializer)
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._scanned = 0
+        self._frame_size = None
+        # the error that failed the decoder, if any
+        self._failed = None
+
+    @property
+    def buffered(self):
+        """ number of bytes received but not yet decoded """
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """
+        appends `data` to the stream and returns an iterator over the
+        messages that have become complete
+
+        A frame that fails to decode raises from the iterator; the frame
+        is consumed first, so the remaining messages can be decoded by
+        iterating over the decoder itself.
+        """
+        if self._failed is not None:
+            return iter(self)
+        if self._offset > 0:
+            del self._buffer[:self._offset]
+            self._scanned -= self._offset
+            self._offset = 0
+        self._buffer.extend(data)
+        return iter(self)
+
+    def __iter__(self):
+        if self._failed is not None:
+            raise ValueError(self._failed)
+        serializer = self.serializer
+        lazy = self.lazy
+        if self.framing == WAMPFraming.LENGTH_PREFIXED:
+            next_frame = self._next_length_prefixed_frame
+        else:
+            next_frame = self._next_newline_frame
+        frame = next_frame()
+        while frame is not None:
+            if serializer.binary or frame.strip():
+                yield WAMPMessage.loads(frame, serializer, lazy)
+            frame = next_frame()
+
+    def _check_frame_size(self, size):
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            self._failed = ("frame of %d bytes exceeds max_frame_size (%d)"
+                            % (size, self.max_frame_size))
+            del self._buffer[:]
+            self._offset = self._scanned = 0
+            self._frame_size = None
+            raise ValueError(self._failed)
+
+    def _next_newline_frame(self):
+        buf = self._buffer
+        end = buf.find('\n', self._scanned)
+        if end < 0:
+            self._scanned = len(buf)
+            self._check_frame_size(self._scanned - self._offset)
+            return None
+        self._check_frame_size(end - self._offset)
+        frame = str(buf[self._offset:end])
+        self._offset = self._scanned = end + 1
+        return frame
+
+    def _next_length_prefixed_frame(self):
+        buf = self._buffer
+        start = self._offset + _length_header.size
+        if self._frame_size is None:
+            if len(buf) < start:
+                return None
+            self._frame_size = _length_header.unpack_from(buf,
+                                                          self._offset)[0]
+            self._check_frame_size(self._frame_size)
+        end = start + self._frame_size
+        if len(buf) < end:
+            return None
+        frame = str(buf[start:end])
+        self._offset = self._scanned = end
+        self._frame_size = None
+        return frame
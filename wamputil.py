@@ -1,4 +1,6 @@
 from collections import Iterable
+from functools import partial
+from threading import Lock
 from weakref import ref
 from inspect import getargspec
 import re
@@ -40,6 +42,155 @@ def iterablate(target, wrapper_cls=tuple, also_wrap=None):
     return target
 
 
+class LRUCache(object):
+
+    """
+    a bounded mapping that evicts its least recently used entries
+
+    `lookup` counts hits and misses, which are reported (along with the
+    current and maximum sizes) by `stats`.  Operations are serialized by
+    a lock, so a cache can be shared between threads.
+
+    Recency is kept in a circular doubly linked list of
+    [prev, next, key, value] links (as in Python 3's functools.lru_cache),
+    so a hit only relinks one entry.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self.clear()
+
+    def _hit(self, link):
+        # move link to the most recently used end of the list
+        root = self._root
+        link_prev, link_next = link[0], link[1]
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+
+    def lookup(self, key, factory):
+        """ returns the value for key, storing factory(key) on a miss """
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self.hits += 1
+                self._hit(link)
+                return link[3]
+            self.misses += 1
+        value = factory(key)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            self._hit(link)
+            return link[3]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+            return link[3]
+
+    def clear(self):
+        with self._lock:
+            self._links = dict()
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._links), 'maxsize': self.maxsize}
+
+    def keys(self):
+        """ returns the keys, least recently used first """
+        with self._lock:
+            keys = []
+            link = self._root[1]
+            while link is not self._root:
+                keys.append(link[2])
+                link = link[1]
+            return keys
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                link[3] = value
+                self._hit(link)
+                return
+            root = self._root
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = self._links[key] = link
+            while len(self._links) > self.maxsize:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self._links[oldest[2]]
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+
+def _analyze_signature(fn):
+    """ returns (free parameters, parameters with defaults, has *args) """
+    try:
+        argspec = getargspec(fn.__call__)
+        implied_self = True
+    except (TypeError, AttributeError):
+        argspec = getargspec(fn)
+        implied_self = False
+    accepts_n = len(argspec.args) if argspec.args else 0
+    if implied_self or (getattr(fn, '__self__', None) is not None):
+        accepts_n -= 1
+    defaults = len(argspec.defaults) if argspec.defaults else 0
+    return accepts_n, defaults, bool(argspec.varargs)
+
+
+def _signature_key(fn):
+    """
+    returns a key that identifies the signature of fn for
+    _signature_cache, or None if fn's signature isn't cacheable
+
+    The key is the code object of the function that will actually be
+    called, the number of its default values, and whether a bound self
+    will be supplied.
+    """
+    call = getattr(getattr(type(fn), '__call__', None), '__func__', None)
+    code = getattr(call, '__code__', None)
+    if code is not None:
+        # an instance of a class that defines __call__
+        return (code, len(call.__defaults__ or ()), True)
+    func = getattr(fn, '__func__', fn)
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        return (code, len(func.__defaults__ or ()),
+                getattr(fn, '__self__', None) is not None)
+    return None
+
+
+# signature analyses, keyed by _signature_key
+_signature_cache = LRUCache(1024)
+
+
 def check_signature(fn, num_args=None, min_args=0, max_args=None):
     """ Checks the call signature of a provided callable
 
@@ -55,6 +206,9 @@ def check_signature(fn, num_args=None, min_args=0, max_args=None):
     min_args, max_args: specify range of argument list lengths to check
     function compatibility.  A value of None for max_args indicates no upper
     bound on the number of arguments the callable must accept
+
+    The inspection of each function (or callable class) is cached, so
+    checking the same callable again only costs a cache lookup
     """
     if num_args is not None:
         min_args = num_args
@@ -62,22 +216,18 @@ def check_signature(fn, num_args=None, min_args=0, max_args=None):
     if max_args is not None and max_args < min_args:
         raise ValueError("max_args cannot be less than min_args(%d)")
 
-    try:
-        argspec = getargspec(fn.__call__)
-        implied_self = True
-    except (TypeError, AttributeError):
-        argspec = getargspec(fn)
-        implied_self = False
-    accepts_n = len(argspec.args) if argspec.args else 0
-    if implied_self or (getattr(fn, '__self__', None) is not None):
-        accepts_n -= 1
-    defaults = len(argspec.defaults) if argspec.defaults else 0
+    key = _signature_key(fn)
+    if key is None:
+        accepts_n, defaults, varargs = _analyze_signature(fn)
+    else:
+        accepts_n, defaults, varargs = _signature_cache.lookup(
+            key, lambda key: _analyze_signature(fn))
     required = accepts_n - defaults
     if required >= 0 and min_args < required:
         raise TypeError("%s requires at least %d free parameters"
                         " but might be called with as few as %d" %
                         (str(fn), required, min_args))
-    if not argspec.varargs:
+    if not varargs:
         if max_args is None or max_args > accepts_n:
             if max_args is None:
                 detail = "%d or more" % min_args
@@ -88,6 +238,10 @@ def check_signature(fn, num_args=None, min_args=0, max_args=None):
                             (str(fn), accepts_n, detail))
 
 
+def _no_ref():
+    return None
+
+
 class WeaklyBoundCallable(object):
 
     """
@@ -100,20 +254,34 @@ class WeaklyBoundCallable(object):
 
     If the wrapped function is a bound method, this will "unbind" it
     for memory management purposes and "rebind" it on call.
+
+    If `on_dead` is given, it is called with this WeaklyBoundCallable
+    when the bound object is garbage collected, so that owners can
+    discard the callable eagerly.
     """
 
-    def __init__(self, fn):
+    __slots__ = ('__func__', '_ref', '_is_bound', '_stored_hash',
+                 '__weakref__')
+
+    def __init__(self, fn, on_dead=None):
         self.__func__ = getattr(fn, '__func__', fn)
+        self._ref = _no_ref
         try:
-            self.__self__ = fn.__self__
+            bound_self = fn.__self__
             self._is_bound = True
         except AttributeError:
+            bound_self = None
             self._is_bound = False
-        self._stored_hash = id(self.__func__) ^ id(self.__self__)
+        if bound_self is not None:
+            if on_dead is None:
+                self._ref = ref(bound_self)
+            else:
+                self._ref = ref(bound_self, _dead_callback(self, on_dead))
+        self._stored_hash = id(self.__func__) ^ id(bound_self)
 
     @property
     def __self__(self):
-        return self._ref() if hasattr(self, '_ref') else None
+        return self._ref()
 
     @__self__.setter
     def __self__(self, value):
@@ -122,28 +290,27 @@ class WeaklyBoundCallable(object):
 
     @__self__.deleter
     def __self__(self):
-        del self._ref
+        self._ref = _no_ref
 
     def reverted(self):
         """ returns copy of callable with original bind state"""
 
         if self._is_bound:
-            return self.__func__.__get__(self.__self__)
+            return self.__func__.__get__(self._ref())
         else:
             return self.__func__
 
     def __call__(self, *args, **kwargs):
         if self._is_bound:
-            return self.__func__(self.__self__, *args, **kwargs)
-        else:
-            return self.__func__(*args, **kwargs)
+            return self.__func__(self._ref(), *args, **kwargs)
+        return self.__func__(*args, **kwargs)
 
     def __eq__(self, other):
         if isinstance(other, WeaklyBoundCallable):
             h = self._stored_hash == other._stored_hash
             f = self.__func__ == getattr(other, '__func__', other)
             b = self._is_bound == other._is_bound
-            s = self.__self__ == other.__self__
+            s = self._ref() == other._ref()
             return h and f and b and s
         return False
 
@@ -154,6 +321,57 @@ class WeaklyBoundCallable(object):
         return self._stored_hash
 
 
+def _dead_callback(callable, on_dead):
+    # refer to the WeaklyBoundCallable weakly, so that it isn't kept
+    # alive by its own weakref's callback
+    callable_ref = ref(callable)
+
+    def callback(dead_ref):
+        callable = callable_ref()
+        if callable is not None:
+            on_dead(callable)
+
+    return callback
+
+
+def when_done(value, on_result, on_error):
+    """
+    arranges for on_result(result) or on_error(exception) to be called
+    once the asynchronous `value` completes; returns False (and calls
+    neither) if `value` is not asynchronous
+
+    Accepted: a concurrent.futures Future (or anything else with
+    add_done_callback and result) and a Twisted-style Deferred (or
+    anything else with addCallbacks).  The callbacks run wherever the
+    value completes, e.g., on an executor's worker thread.
+    """
+    if hasattr(value, 'add_done_callback'):
+        value.add_done_callback(partial(_future_done, on_result, on_error))
+        return True
+    if hasattr(value, 'addCallbacks'):
+        value.addCallbacks(partial(_deferred_done, on_result),
+                           partial(_deferred_done, on_error, failure=True))
+        return True
+    return False
+
+
+def _future_done(on_result, on_error, future):
+    try:
+        result = future.result()
+    except BaseException as e:
+        # the future's outcome (including CancelledError), which need not
+        # be an Exception
+        on_error(e)
+    else:
+        on_result(result)
+
+
+def _deferred_done(on_done, value, failure=False):
+    # a Deferred's errback gets a Failure, which wraps the exception
+    on_done(getattr(value, 'value', value) if failure else value)
+    # returning None ends the Deferred's chain as handled
+
+
 class AttributeFactoryMixin(object):
 
     """
@@ -190,6 +408,12 @@ class AttributeFactoryMixin(object):
         return AttributeFactoryMixin._get_or_memoize(cls, name)
 
 
+# per-class (instances by int, instances by str) lookup tables for
+# _EnumishMixin, built on first use and discarded whenever any enumish
+# class's values change
+_enumish_tables = dict()
+
+
 class _EnumishMixin(object):
 
     """
@@ -199,6 +423,10 @@ class _EnumishMixin(object):
     where the parameters are constrained to be in the _values list,
     i.e., an int must be less than len(cls._values), and a str must
     be in cls.values
+
+    Instances are looked up in precomputed int -> instance and
+    str -> instance tables, which are rebuilt after _add_value_ or
+    _remove_value_
     """
 
     class EnumishMetaclass(AttributeFactoryMixin, type):
@@ -212,30 +440,44 @@ class _EnumishMixin(object):
     _basetype = NotImplemented
 
     def __new__(cls, value):
+        tables = _enumish_tables.get(cls) or cls._build_tables()
         if isinstance(value, int):
-            if value >= len(cls._values):
-                raise AttributeError("%s: %d is not a valid value" %
-                                     (cls.__name__, value))
-            values = {int: value, str: cls._values[value]}
+            if 0 <= value < len(tables[0]):
+                return tables[0][value]
+            raise AttributeError("%s: %d is not a valid value" %
+                                 (cls.__name__, value))
         elif isinstance(value, basestring):
-            if value not in cls._values:
+            try:
+                return tables[1][value]
+            except KeyError:
                 raise AttributeError("%s: '%s' is not a valid value" %
                                      (cls.__name__, value))
-            values = {int: cls._values.index(value), str: str(value)}
         else:
             raise TypeError("%s: argument must be <int> or <str>" %
                             cls.__name__)
-        new = cls.__metaclass__._get_or_memoize(cls, values[str],
-                                                values[cls._basetype],
-                                                cls._basetype.__new__)
-        new.int = values[int]
-        new.str = values[str]
-        return new
+
+    @classmethod
+    def _build_tables(cls):
+        by_int = []
+        by_str = dict()
+        basevalue = {int: lambda i, name: i, str: lambda i, name: name}
+        for i, name in enumerate(cls._values):
+            name = str(name)
+            new = cls.__metaclass__._get_or_memoize(
+                cls, name, basevalue[cls._basetype](i, name),
+                cls._basetype.__new__)
+            new.int = i
+            new.str = name
+            by_int.append(new)
+            by_str[name] = new
+        tables = _enumish_tables[cls] = (by_int, by_str)
+        return tables
 
     @classmethod
     def _add_value_(cls, value):
         if value not in cls._values:
             cls._values.append(value)
+            _enumish_tables.clear()
         else:
             raise ValueError(
                 "'%s' already a value of %s" % (value, cls.__name__))
@@ -251,6 +493,8 @@ class _EnumishMixin(object):
         except ValueError:
             raise ValueError(
                 "'%s' is not a value of %s" % (value, cls.__name__))
+        finally:
+            _enumish_tables.clear()
 
 
 class EnumishStr(_EnumishMixin, str):